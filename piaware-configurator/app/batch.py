@@ -0,0 +1,127 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import contextvars
+from flask import current_app
+from http import HTTPStatus
+import time
+
+# Upper bound on the number of sub-requests of a batch running at once
+BATCH_WORKERS = 4
+
+# Sub-requests accepted in one batch
+MAX_BATCH_REQUESTS = 16
+
+# Requests that only read state, so consecutive ones in a batch can run concurrently. Any other
+# request runs on its own, after the ones before it and before the ones after it.
+BATCH_READ_REQUESTS = frozenset([
+    'piaware_config_read',
+    'get_pending_network_config',
+    'get_device_info',
+    'get_device_state',
+    'get_network_info',
+    'get_wifi_networks',
+])
+
+# {owner: dict} of state pinned by ConfigSnapshot and StatusFile for the current batch
+_snapshot_pins = contextvars.ContextVar('snapshot_pins', default=None)
+
+
+def snapshot_pin(owner):
+    """ Returns the dict where owner keeps state pinned for the current batch, or None outside a
+        batch. The dict is empty the first time owner asks for it in a batch.
+
+    """
+    pins = _snapshot_pins.get()
+    if pins is None:
+        return None
+
+    return pins.setdefault(owner, {})
+
+
+@contextmanager
+def pinned_snapshots():
+    """ Within this block, each config snapshot and status.json file is checked on disk once and
+        then served from the version first seen, so every read in a batch sees the same state.
+        Context copied with contextvars.copy_context() shares the pins.
+
+    """
+    token = _snapshot_pins.set({})
+    try:
+        yield
+    finally:
+        _snapshot_pins.reset(token)
+
+
+class BatchRunner:
+    """ Runs the sub-requests of a batch envelope.
+
+        Consecutive read requests run concurrently on a bounded worker pool; every other request
+        runs alone, in order. All of them share one pinned config snapshot and status.json parse.
+        Each sub-request gets its own result, so one failing request does not affect the others.
+    """
+    def __init__(self, max_workers=BATCH_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='batch')
+        self.batches = 0
+        self.requests = 0
+        self.errors = 0
+
+    def run(self, requests, dispatch):
+        """ Returns a list with one {"request", "status", "response"} result per sub-request.
+            dispatch(request, payload) handles a single request and returns (response, status).
+
+        """
+        app = current_app._get_current_object()
+        results = [None] * len(requests)
+        self.batches += 1
+        self.requests += len(requests)
+
+        with pinned_snapshots():
+            reads = []
+            for index, payload in enumerate(requests):
+                if isinstance(payload, dict) and isinstance(payload.get('request'), str) \
+                        and payload['request'] in BATCH_READ_REQUESTS:
+                    reads.append(index)
+                    continue
+                self._run_concurrently(app, requests, reads, dispatch, results)
+                reads = []
+                results[index] = self._call(app, payload, dispatch)
+            self._run_concurrently(app, requests, reads, dispatch, results)
+
+        return results
+
+    def _run_concurrently(self, app, requests, indexes, dispatch, results):
+        if len(indexes) == 1:
+            results[indexes[0]] = self._call(app, requests[indexes[0]], dispatch)
+            return
+
+        futures = [(index, self._executor.submit(contextvars.copy_context().run, self._call, app, requests[index], dispatch))
+                   for index in indexes]
+        for index, future in futures:
+            results[index] = future.result()
+
+    def _call(self, app, payload, dispatch):
+        start = time.monotonic()
+        with app.app_context():
+            request = payload.get('request') if isinstance(payload, dict) else None
+            if request is None:
+                response, status_code = {"success": False, "error": "Missing request field"}, HTTPStatus.BAD_REQUEST
+            else:
+                try:
+                    response, status_code = dispatch(request, payload)
+                except Exception as e:
+                    current_app.logger.error(f'Error handling batched {request} request: {e}')
+                    response, status_code = {"success": False, "error": "Server error occurred"}, HTTPStatus.INTERNAL_SERVER_ERROR
+
+        if status_code >= 400:
+            self.errors += 1
+
+        return {'request': request,
+                'status': int(status_code),
+                'response': response,
+                'elapsed_ms': round((time.monotonic() - start) * 1000, 2)}
+
+    def stats(self):
+        return {'batches': self.batches, 'requests': self.requests, 'errors': self.errors}
+
+
+batch_runner = BatchRunner()
@@ -1,12 +1,13 @@
 from flask import current_app
 
-piaware_config_read_whitelist = [
+# Setting names that may be read and written. frozensets, so checking a name is a hash lookup.
+piaware_config_read_whitelist = frozenset([
     "allow-ble-setup",  "image-type", "flightfeeder-serial", "rtlsdr-gain", "uat-sdr-gain",
     "wireless-network", "wireless-type", "wireless-address", "wireless-ssid", "wireless-netmask", "wireless-gateway", "wireless-country", "wireless-broadcast", "wireless-nameservers",
     "wired-network", "wired-type", "wired-address", "wired-netmask", "wired-gateway", "wired-broadcast", "wired-nameservers"
-    ]
-piaware_config_write_whitelist = ["allow-ble-setup", "wireless-network", "wireless-type", "wireless-address", "wireless-ssid", "wireless-netmask", "wireless-gateway", "wireless-country", "wireless-broadcast", "wireless-nameservers", "wireless-password",
-    "wired-network", "wired-type", "wired-address", "wired-netmask", "wired-gateway", "wired-broadcast", "wired-nameservers", "rtlsdr-gain"]
+    ])
+piaware_config_write_whitelist = frozenset(["allow-ble-setup", "wireless-network", "wireless-type", "wireless-address", "wireless-ssid", "wireless-netmask", "wireless-gateway", "wireless-country", "wireless-broadcast", "wireless-nameservers", "wireless-password",
+    "wired-network", "wired-type", "wired-address", "wired-netmask", "wired-gateway", "wired-broadcast", "wired-nameservers", "rtlsdr-gain"])
 
 class PiAwareConfigException(Exception):
     def __init__(self, setting):
@@ -20,4 +21,18 @@ class PiAwareConfigPermissionException(PiAwareConfigException):
 class PiAwareConfigAsciiStringException(PiAwareConfigException):
     def __init__(self, setting):
         super().__init__(setting)
-        current_app.logger.error(f'Not a valid ASCII string')
\ No newline at end of file
+        current_app.logger.error(f'Not a valid ASCII string')
+
+def validate_settings(settings, whitelist):
+    """ Check every setting name before anything is read or written
+
+    """
+    for setting in settings:
+        # Every whitelisted name is ASCII, so only names that fail the lookup need the ASCII check
+        if type(setting) is str and setting in whitelist:
+            continue
+
+        if type(setting) is not str or not setting.isascii():
+            raise PiAwareConfigAsciiStringException(setting)
+
+        raise PiAwareConfigPermissionException(setting)
@@ -0,0 +1,178 @@
+import os
+import time
+from threading import Lock
+
+from .batch import snapshot_pin
+from .common import PiAwareConfigException
+from .tcl import tcl_executor
+
+# Files that make up the piaware combined config. The flightfeeder volatile config is layered
+# on top of the combined config when it exists, so pending network changes invalidate it too.
+PIAWARE_CONFIG_FILES = (
+    "/etc/piaware.conf",
+    "/boot/piaware-config.txt",
+    "/boot/firmware/piaware-config.txt",
+    "/usr/share/piaware-support/piaware-image-config.txt",
+    "/run/flightfeeder-volatile-config.txt",
+)
+
+PENDING_NETWORK_CONFIG_FILES = (
+    "/run/flightfeeder-volatile-config.txt",
+)
+
+
+class ConfigSnapshot:
+    """ In-memory snapshot of a Tcl config object (piawareConfig, flightfeederNetworkConfig)
+
+        The config is re-read with read_config only when the inode/mtime/size of one of the
+        underlying config files changes, or after invalidate() is called by a write. Values
+        are fetched from Tcl once per snapshot and served from memory afterwards. Within a
+        batch the files are only checked by the first get(), and the values it returns are
+        pinned for the rest of the batch.
+
+        With skip_unchanged, write() leaves out settings whose effective value already matches.
+        That is wrong for a config whose file is later copied elsewhere, like the pending network
+        config: a setting that only matches its default would never be written to the file.
+    """
+    def __init__(self, config_name, config_files, skip_unchanged=True):
+        self.config_name = config_name
+        self.config_files = config_files
+        self.skip_unchanged = skip_unchanged
+        self._lock = Lock()
+        self._stamp = None
+        self._values = {}
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.writes = 0
+        self.skipped_writes = 0
+
+    def _file_stamp(self):
+        stamp = []
+        for path in self.config_files:
+            try:
+                st = os.stat(path)
+                stamp.append((st.st_ino, st.st_mtime_ns, st.st_size))
+            except OSError:
+                stamp.append(None)
+
+        return tuple(stamp)
+
+    def _refresh(self):
+        """ Reload the config from disk if any of the underlying files changed
+
+        """
+        stamp = self._file_stamp()
+        if stamp != self._stamp:
+            tcl_executor.eval(f'{self.config_name} read_config')
+            self._stamp = stamp
+            self._values = {}
+            self.reloads += 1
+
+    def _lookup(self, setting):
+        try:
+            value = self._values[setting]
+            self.hits += 1
+        except KeyError:
+            value = str(tcl_executor.call(self.config_name, 'get', setting))
+            self._values[setting] = value
+            self.misses += 1
+
+        return value
+
+    def get(self, setting):
+        """ Return the current value of setting as a string
+
+        """
+        pinned = snapshot_pin(self)
+        if pinned and setting in pinned:
+            self.hits += 1
+            return pinned[setting]
+
+        with self._lock:
+            if not pinned:
+                self._refresh()
+            value = self._lookup(setting)
+
+        if pinned is not None:
+            pinned[setting] = value
+
+        return value
+
+    def write(self, settings):
+        """ Apply the settings dict to the in-memory config and persist them with a single write_config.
+
+            With skip_unchanged, settings whose value already matches the current config are skipped,
+            and write_config is not called at all when nothing changed. Either all changed settings are written or none
+            are: if any option is rejected the config is re-read from disk to discard the options
+            already applied. Returns the list of changed settings and a dict of timings in milliseconds.
+        """
+        timings = {}
+        self._unpin()
+        with self._lock:
+            setting = None
+            try:
+                start = time.monotonic()
+                self._refresh()
+                if self.skip_unchanged:
+                    changed = [setting for setting, value in settings.items() if self._lookup(setting) != str(value)]
+                else:
+                    changed = list(settings)
+                setting = None
+                timings['read_ms'] = _elapsed_ms(start)
+
+                if not changed:
+                    self.skipped_writes += 1
+                    return changed, timings
+
+                start = time.monotonic()
+                for setting in changed:
+                    tcl_executor.call(self.config_name, 'set_option', setting, settings[setting])
+                setting = None
+                timings['apply_ms'] = _elapsed_ms(start)
+
+                start = time.monotonic()
+                tcl_executor.eval(f'{self.config_name} write_config')
+                timings['write_ms'] = _elapsed_ms(start)
+            except Exception:
+                try:
+                    tcl_executor.eval(f'{self.config_name} read_config')
+                except Exception:
+                    pass
+                self._stamp = None
+                self._values = {}
+                raise PiAwareConfigException(setting if setting is not None else ', '.join(settings))
+
+            self._stamp = None
+            self._values = {}
+            self.writes += 1
+
+        return changed, timings
+
+    def invalidate(self):
+        """ Force the next get() to re-read the config from disk
+
+        """
+        self._unpin()
+        with self._lock:
+            self._stamp = None
+            self._values = {}
+
+    def _unpin(self):
+        # Reads after a write or invalidate() in a batch must see the new config
+        pinned = snapshot_pin(self)
+        if pinned is not None:
+            pinned.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'reloads': self.reloads,
+                'writes': self.writes, 'skipped_writes': self.skipped_writes}
+
+
+def _elapsed_ms(start):
+    return round((time.monotonic() - start) * 1000, 2)
+
+
+piaware_config_snapshot = ConfigSnapshot('piawareConfig', PIAWARE_CONFIG_FILES)
+pending_network_config_snapshot = ConfigSnapshot('flightfeederNetworkConfig', PENDING_NETWORK_CONFIG_FILES,
+                                                 skip_unchanged=False)
@@ -0,0 +1,131 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import contextvars
+from flask import current_app
+from threading import Lock
+import time
+
+from .piaware_config_helpers import get_piaware_config, get_network_state_and_ip, get_device_location, get_unique_feederid
+from .status_cache import piaware_status_file, flightfeeder_status_file
+
+# Upper bound on the number of device state lookups running at once
+DEVICE_STATE_WORKERS = 4
+
+# Seconds to wait for all sources before answering with the last known values of the slow ones
+DEVICE_STATE_TIMEOUT = 2
+
+
+def _read_wireless_config():
+    return get_piaware_config('wireless-ssid'), get_piaware_config('wireless-country')
+
+
+def _read_status_json():
+    """ Returns which status.json was read ('flightfeeder', 'piaware' or None) and its contents
+
+    """
+    for source, status_file in (('flightfeeder', flightfeeder_status_file), ('piaware', piaware_status_file)):
+        try:
+            return source, status_file.get().status
+        except FileNotFoundError:
+            continue
+
+    return None, None
+
+
+# name -> (function, value used if the source has never completed)
+DEVICE_STATE_SOURCES = {
+    'wireless_config': (_read_wireless_config, (None, None)),
+    'route': (get_network_state_and_ip, (False, "", "")),
+    'location': (get_device_location, ""),
+    'feeder_id': (get_unique_feederid, ""),
+    'status_json': (_read_status_json, (None, None)),
+}
+
+
+class DeviceStateGatherer:
+    """ Runs the independent device state lookups concurrently on a bounded worker pool.
+
+        gather() waits up to timeout seconds in total. A source that has not finished by then, or
+        that failed, is answered with its last known value and reported as stale; a lookup still
+        running keeps going in the background and refreshes the last known value when it
+        completes, so it is never started twice at the same time.
+    """
+    def __init__(self, sources, max_workers=DEVICE_STATE_WORKERS):
+        self.sources = sources
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='device-state')
+        self._lock = Lock()
+        self._pending = {}
+        self._last = {}
+        self.timeouts = 0
+        self.errors = 0
+
+    def _call(self, app, name, func):
+        start = time.monotonic()
+        with app.app_context():
+            value = func()
+        elapsed_ms = round((time.monotonic() - start) * 1000, 2)
+
+        with self._lock:
+            self._last[name] = value
+            self._pending.pop(name, None)
+
+        return value, elapsed_ms
+
+    def _discard(self, name, future):
+        # Forget a failed lookup so the next request retries it
+        if future.exception() is not None:
+            with self._lock:
+                if self._pending.get(name) is future:
+                    del self._pending[name]
+
+    def _submit(self, app, name, func):
+        with self._lock:
+            future = self._pending.get(name)
+            if future is None:
+                # Copy the context so lookups share the snapshots pinned by a batch
+                future = self._executor.submit(contextvars.copy_context().run, self._call, app, name, func)
+                self._pending[name] = future
+                future.add_done_callback(lambda f: self._discard(name, f))
+
+        return future
+
+    def gather(self, timeout=DEVICE_STATE_TIMEOUT):
+        """ Returns a dict of source values, the list of stale sources and per-source timings in
+            milliseconds (None for sources that did not finish in time). A failing source with no
+            last known value re-raises its exception.
+
+        """
+        app = current_app._get_current_object()
+        futures = {name: self._submit(app, name, func) for name, (func, _) in self.sources.items()}
+        deadline = time.monotonic() + timeout
+
+        values, stale, timings = {}, [], {}
+        for name, future in futures.items():
+            try:
+                values[name], timings[name] = future.result(timeout=max(0, deadline - time.monotonic()))
+                continue
+            except FutureTimeoutError:
+                self.timeouts += 1
+                current_app.logger.warning(f'Timed out getting {name} for device state')
+                error = None
+            except Exception as e:
+                self.errors += 1
+                current_app.logger.error(f'Error getting {name} for device state: {e}')
+                error = e
+
+            with self._lock:
+                if name in self._last:
+                    values[name] = self._last[name]
+                elif error is not None:
+                    raise error
+                else:
+                    values[name] = self.sources[name][1]
+            stale.append(name)
+            timings[name] = None
+
+        return values, stale, timings
+
+    def stats(self):
+        return {'timeouts': self.timeouts, 'errors': self.errors, 'running': len(self._pending)}
+
+
+device_state_gatherer = DeviceStateGatherer(DEVICE_STATE_SOURCES)
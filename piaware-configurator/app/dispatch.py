@@ -0,0 +1,69 @@
+from http import HTTPStatus
+import inspect
+
+from .common import PiAwareConfigAsciiStringException, PiAwareConfigPermissionException, validate_settings
+
+
+class PayloadSchema:
+    """ Expected shape of a request's request_payload, checked before its handler runs.
+
+        payload_type is list (setting names) or dict (setting: value). When whitelist is given,
+        every setting name must be in it. The error messages are the ones each request has
+        always answered with, so clients see the same responses.
+    """
+    def __init__(self, payload_type, type_error, missing_error="Missing request_payload field",
+                 whitelist=None, not_allowed_error=None):
+        self.payload_type = payload_type
+        self.whitelist = whitelist
+        self.not_allowed_error = not_allowed_error
+        self.missing_error = missing_error
+        self.type_error = type_error
+
+    def check(self, json_payload):
+        """ Returns None if json_payload is valid, otherwise the error response and status code
+
+        """
+        try:
+            payload = json_payload['request_payload']
+        except KeyError:
+            return {"success": False, "error": self.missing_error}, HTTPStatus.BAD_REQUEST
+
+        if type(payload) is not self.payload_type:
+            return {"success": False, "error": self.type_error}, HTTPStatus.BAD_REQUEST
+
+        if self.whitelist is not None:
+            try:
+                validate_settings(payload, self.whitelist)
+            except PiAwareConfigAsciiStringException:
+                return {"success": False, "error": "Badly formatted setting"}, HTTPStatus.OK
+            except PiAwareConfigPermissionException as e:
+                return {"success": False, "error": self.not_allowed_error.format(e.setting)}, HTTPStatus.OK
+
+        return None
+
+
+class RequestHandler:
+    """ Entry of the request registry: the handler function for a request and the schema its
+        payload is checked against. Handlers that take an argument are passed the whole request.
+
+        dispatch(json_payload) runs the check and the handler. It is put together once here, so
+        handling a request costs no more calls than the handler doing its own checks.
+    """
+    def __init__(self, handler, schema=None):
+        self.handler = handler
+        self.schema = schema
+        self.takes_request = bool(inspect.signature(handler).parameters)
+
+        call = handler if self.takes_request else (lambda json_payload: handler())
+        if schema is None:
+            self.dispatch = call
+        else:
+            check = schema.check
+
+            def dispatch(json_payload):
+                return check(json_payload) or call(json_payload)
+
+            self.dispatch = dispatch
+
+    def __call__(self, json_payload):
+        return self.dispatch(json_payload)
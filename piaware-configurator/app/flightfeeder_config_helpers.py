@@ -1,20 +1,16 @@
 from flask import current_app
-import tohil
+import time
 from .common import *
+from .config_cache import pending_network_config_snapshot
 
 def get_pending_network_config(setting):
     """ Getter function for pending network settings
 
     """
-    if not setting.isascii():
-       raise PiAwareConfigAsciiStringException(setting)
-
-    if setting not in piaware_config_read_whitelist:
-       raise PiAwareConfigPermissionException(setting)
+    validate_settings((setting,), piaware_config_read_whitelist)
 
     try:
-        tohil.eval('flightfeederNetworkConfig read_config')
-        value = str(tohil.call('flightfeederNetworkConfig', 'get', setting))
+        value = pending_network_config_snapshot.get(setting)
     except Exception:
         current_app.logger.error(f'Error reading {setting} from pending network configuration')
         raise PiAwareConfigException(setting)
@@ -25,18 +21,28 @@ def set_pending_network_config(setting, value):
     """ Setter function for pending network settings
 
     """
-    if not setting.isascii():
-       raise PiAwareConfigAsciiStringException(setting)
+    return set_pending_network_configs({setting: value})
+
 
-    if setting not in piaware_config_write_whitelist:
-        raise PiAwareConfigPermissionException(setting)
+def set_pending_network_configs(settings):
+    """ Batch setter for pending network settings. Every setting is validated up front and all of them
+        are persisted with a single write_config, so either all settings are written or none are.
+
+        Every setting is written, even one that matches its default, so that it is in the volatile
+        file when the pending settings are saved. Returns the list of written settings and a dict
+        of timings in milliseconds
+    """
+    start = time.monotonic()
+    validate_settings(settings, piaware_config_write_whitelist)
+    validate_ms = round((time.monotonic() - start) * 1000, 2)
 
     try:
-        tohil.eval('flightfeederNetworkConfig read_config')
-        tohil.call('flightfeederNetworkConfig', 'set_option', setting, value)
-        tohil.eval('flightfeederNetworkConfig write_config')
-    except Exception:
-        current_app.logger.error(f'Error setting {setting} to {value} in pending network configuration.')
-        raise PiAwareConfigException(setting)
+        changed, timings = pending_network_config_snapshot.write(settings)
+    except PiAwareConfigException as e:
+        current_app.logger.error(f'Error writing {e.setting} to pending network configuration.')
+        raise
+
+    timings['validate_ms'] = validate_ms
+    current_app.logger.debug('Wrote %d of %d pending network settings: %s', len(changed), len(settings), timings)
 
-    return
\ No newline at end of file
+    return changed, timings
@@ -0,0 +1,123 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+# Event masks from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        _libc = libc
+
+    return _libc
+
+
+def is_available():
+    """ Returns whether inotify can be used on this system
+
+    """
+    try:
+        libc = _load_libc()
+        return hasattr(libc, 'inotify_init1')
+    except OSError:
+        return False
+
+
+class InotifyWatcher:
+    """ Minimal ctypes wrapper around Linux inotify.
+
+        The descriptor is non-blocking and waited on with select(), so under eventlet's monkey
+        patching a waiting greenlet yields to the hub instead of blocking the worker.
+    """
+    def __init__(self):
+        libc = _load_libc()
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.fd = fd
+        self._watches = {}
+
+    def add_watch(self, path, mask):
+        """ Watch path for the events in mask. Returns the watch descriptor
+
+        """
+        wd = _load_libc().inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self._watches[wd] = path
+
+        return wd
+
+    def rm_watch(self, wd):
+        """ Stop watching the watch descriptor returned by add_watch
+
+        """
+        self._watches.pop(wd, None)
+        if _load_libc().inotify_rm_watch(self.fd, wd) < 0:
+            err = ctypes.get_errno()
+            # EINVAL: the kernel already dropped the watch because the file was deleted
+            if err != errno.EINVAL:
+                raise OSError(err, os.strerror(err))
+
+    def read_events(self, timeout=None):
+        """ Wait up to timeout seconds for events.
+
+            Returns a list of (watched path, mask, name) tuples, empty on timeout.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                return []
+            raise
+
+        events = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, _cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0').decode('utf-8', errors='replace')
+            offset += length
+            events.append((self._watches.get(wd), mask, name))
+
+        return events
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            self._watches = {}
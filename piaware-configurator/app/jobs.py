@@ -0,0 +1,169 @@
+from collections import OrderedDict
+import subprocess
+from threading import Lock
+import time
+import uuid
+
+# Commands run by each kind of job. They are allowed by the piaware-configurator sudoers file.
+JOB_COMMANDS = {
+    'restart_receiver': ["sudo", "/usr/bin/piaware-restart-receiver"],
+    'restart_network': ["sudo", "/usr/bin/piaware-restart-network"],
+    'reboot': ["sudo", "/sbin/shutdown", "-r", "now"],
+}
+
+# Seconds before a job's command is killed
+JOB_TIMEOUT = 300
+
+# Finished jobs kept for polling
+MAX_FINISHED_JOBS = 50
+
+# Characters of command output kept with a job
+JOB_OUTPUT_CHARS = 2000
+
+
+class Job:
+    def __init__(self, kind):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.state = 'queued'
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.returncode = None
+        self.output = ""
+        self.error = None
+        self.merged_requests = 0
+        self.callbacks = []
+
+    @property
+    def active(self):
+        return self.state in ('queued', 'running')
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'kind': self.kind,
+            'state': self.state,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'returncode': self.returncode,
+            'output': self.output,
+            'error': self.error,
+            'merged_requests': self.merged_requests,
+        }
+
+
+class JobManager:
+    """ Runs long operations (restarts, reboot) in the background as jobs.
+
+        submit() returns right away. Further submissions of a kind are merged into the job of that
+        kind that is queued or running. A caller whose change may have landed after a running job
+        started (new settings for a network restart) submits with after_running=True to get a
+        follow-up job queued behind it instead. Every state change is emitted to Socket.IO clients
+        as a "job" event, and jobs can be polled with get() until they are among the oldest
+        MAX_FINISHED_JOBS finished jobs.
+    """
+    def __init__(self):
+        self.socketio = None
+        self.logger = None
+        self._lock = Lock()
+        self._jobs = OrderedDict()
+        self._queued = {}
+        self._running = {}
+
+    def init_app(self, socketio, logger):
+        self.socketio = socketio
+        self.logger = logger
+
+    def submit(self, kind, on_finished=None, after_running=False):
+        """ Queue a job of kind, or return the one of that kind already queued or running. With
+            after_running, a running job is not joined and a new one is queued to start when it
+            finishes. on_finished(job) is called when the job ends.
+
+        """
+        with self._lock:
+            job = self._queued.get(kind)
+            if job is None and not after_running:
+                job = self._running.get(kind)
+            if job is not None:
+                job.merged_requests += 1
+                if on_finished is not None:
+                    job.callbacks.append(on_finished)
+                self.logger.info(f'Merged {kind} request into {job.state} job {job.id}')
+                return job
+
+            job = Job(kind)
+            if on_finished is not None:
+                job.callbacks.append(on_finished)
+            self._jobs[job.id] = job
+            self._queued[kind] = job
+            # Otherwise it is started when the running job of its kind finishes
+            start = kind not in self._running
+
+        if start:
+            self.logger.info(f'Starting {kind} job {job.id}')
+        else:
+            self.logger.info(f'Queued {kind} job {job.id} behind the running one')
+        self._emit(job)
+        if start:
+            self.socketio.start_background_task(self._run, job)
+
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def _emit(self, job):
+        self.socketio.emit('job', job.to_dict())
+
+    def _run(self, job):
+        with self._lock:
+            del self._queued[job.kind]
+            self._running[job.kind] = job
+            job.state = 'running'
+            job.started = time.time()
+        self._emit(job)
+
+        try:
+            proc = subprocess.run(JOB_COMMANDS[job.kind], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=JOB_TIMEOUT)
+            job.returncode = proc.returncode
+            job.output = proc.stdout.decode('utf-8', errors='replace')[-JOB_OUTPUT_CHARS:]
+            job.state = 'succeeded' if proc.returncode == 0 else 'failed'
+        except subprocess.TimeoutExpired:
+            job.state = 'failed'
+            job.error = f'Timed out after {JOB_TIMEOUT} seconds'
+        except Exception as e:
+            job.state = 'failed'
+            job.error = str(e)
+
+        job.finished = time.time()
+        with self._lock:
+            del self._running[job.kind]
+            next_job = self._queued.get(job.kind)
+            finished = [job_id for job_id, j in self._jobs.items() if not j.active]
+            for job_id in finished[:-MAX_FINISHED_JOBS]:
+                del self._jobs[job_id]
+
+        if job.state == 'failed':
+            self.logger.error(f'{job.kind} job {job.id} failed: {job.error or job.output.strip()}')
+        else:
+            self.logger.info(f'{job.kind} job {job.id} finished')
+
+        for callback in job.callbacks:
+            try:
+                callback(job)
+            except Exception as e:
+                self.logger.error(f'Error finishing {job.kind} job {job.id}: {e}')
+
+        self._emit(job)
+
+        if next_job is not None:
+            self.logger.info(f'Starting queued {next_job.kind} job {next_job.id}')
+            self.socketio.start_background_task(self._run, next_job)
+
+    def stats(self):
+        return {'jobs': len(self._jobs), 'queued': sorted(self._queued), 'running': sorted(self._running)}
+
+
+job_manager = JobManager()
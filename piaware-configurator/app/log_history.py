@@ -0,0 +1,497 @@
+from collections import OrderedDict
+from datetime import datetime, timezone
+import json
+import os
+import re
+from threading import Lock
+import time
+import zlib
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# Default and maximum number of lines returned per page
+PAGE_LINES = 200
+PAGE_MAX_LINES = 1000
+
+# Stop scanning and return a partial page after this many lines have been examined, so a filter
+# that matches nothing cannot tie up the worker for the whole log history
+PAGE_MAX_SCANNED_LINES = 200000
+
+# Sparse index: remember a resume point roughly every INDEX_INTERVAL bytes of (uncompressed) log,
+# keeping at most INDEX_MAX_CHECKPOINTS per file and indexes for at most INDEX_MAX_FILES files
+INDEX_INTERVAL = 1024*1024
+INDEX_MAX_CHECKPOINTS = 32
+INDEX_MAX_FILES = 16
+
+READ_CHUNK_BYTES = 64*1024
+
+SEVERITY_LEVELS = ('info', 'warning', 'error')
+
+# Longest regular expression a client may filter log lines with
+MAX_FILTER_REGEX_LENGTH = 200
+
+# Filter regexes only look at this many characters of each line, which covers piaware's lines
+MAX_FILTER_LINE_LENGTH = 256
+
+# Most backtracking a filter regex may do from one position in a line: room for one unbounded
+# repeat such as .* followed by two alternatives, or for small bounded repeats
+MAX_FILTER_FAN_OUT = 2 * (MAX_FILTER_LINE_LENGTH + 1)
+
+_REPEAT_OPCODES = tuple(op for op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT,
+                                      getattr(sre_parse, 'POSSESSIVE_REPEAT', None)) if op is not None)
+_ATOMIC_GROUP = getattr(sre_parse, 'ATOMIC_GROUP', None)
+
+_error_regex = re.compile(rb'\b(error|errors|failed|failure|fail|exception|traceback|fatal|critical)\b', re.IGNORECASE)
+_warning_regex = re.compile(rb'\b(warning|warn|timeout|timed out|unable|lost|disconnected|retrying)\b', re.IGNORECASE)
+_error_str_regex = re.compile(_error_regex.pattern.decode(), re.IGNORECASE)
+_warning_str_regex = re.compile(_warning_regex.pattern.decode(), re.IGNORECASE)
+
+_rfc3339_regex = re.compile(rb'^(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(\.\d+)?(Z|[+-]\d{2}:?\d{2})?')
+_traditional_regex = re.compile(rb'^([A-Z][a-z]{2}) +(\d{1,2}) (\d{2}):(\d{2}):(\d{2}) ')
+_months = {m: i for i, m in enumerate((b'Jan', b'Feb', b'Mar', b'Apr', b'May', b'Jun',
+                                       b'Jul', b'Aug', b'Sep', b'Oct', b'Nov', b'Dec'), start=1)}
+
+_rotated_regex = re.compile(r'^\.(\d+)(\.gz)?$')
+
+
+class LogCursorError(Exception):
+    pass
+
+
+def parse_time(value):
+    """ Parse a query time given either as seconds since the epoch or as an ISO 8601 string.
+        Raises ValueError if it is neither.
+
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        return time.mktime(dt.timetuple()) + dt.microsecond / 1e6
+
+    return dt.timestamp()
+
+
+def _fan_out(subpattern, in_repeat):
+    """ Returns an upper bound on the number of ways subpattern can be tried from one position in
+        a line of MAX_FILTER_LINE_LENGTH characters. Raises ValueError for constructs whose
+        backtracking cannot be bounded that way: anything repeated or alternated inside a repeat,
+        and backreferences.
+
+    """
+    fan_out = 1
+    for op, av in subpattern:
+        if op in _REPEAT_OPCODES:
+            low, high, item = av
+            if in_repeat:
+                raise ValueError('regex must not contain nested quantifiers')
+            fan_out *= max(1, min(high, MAX_FILTER_LINE_LENGTH) - low + 1) * _fan_out(item, high > 1)
+        elif op == sre_parse.SUBPATTERN:
+            fan_out *= _fan_out(av[-1], in_repeat)
+        elif op == _ATOMIC_GROUP:
+            fan_out *= _fan_out(av, in_repeat)
+        elif op == sre_parse.BRANCH:
+            if in_repeat:
+                raise ValueError('regex must not contain alternation inside a repeat')
+            fan_out *= sum(_fan_out(branch, in_repeat) for branch in av[1])
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            fan_out *= _fan_out(av[1], in_repeat)
+        elif op in (sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS):
+            raise ValueError('regex must not contain backreferences')
+
+    return fan_out
+
+
+class FilterRegex:
+    """ A client's log filter regex, compiled by compile_filter_regex. search() only looks at the
+        first MAX_FILTER_LINE_LENGTH characters of a line, as if the line ended there.
+
+    """
+    def __init__(self, regex):
+        self.regex = regex
+        self.pattern = regex.pattern
+
+    def search(self, line):
+        return self.regex.search(line, 0, MAX_FILTER_LINE_LENGTH)
+
+
+def compile_filter_regex(pattern):
+    """ Compile a regular expression sent by a client to filter log lines (str or bytes).
+
+        Client patterns run against every line on the shared event loop, so the work one pattern
+        can do per line is bounded: lines are cut at MAX_FILTER_LINE_LENGTH, and patterns are
+        refused if they are longer than MAX_FILTER_REGEX_LENGTH, repeat or alternate inside a
+        repeat such as (a+)+ or (a|aa)+, use a backreference, or combine repeats that could
+        backtrack more than MAX_FILTER_FAN_OUT ways from one position, such as .*.*x.
+        Raises ValueError if refused or invalid.
+    """
+    if len(pattern) > MAX_FILTER_REGEX_LENGTH:
+        raise ValueError(f'regex must be at most {MAX_FILTER_REGEX_LENGTH} characters')
+
+    try:
+        if _fan_out(sre_parse.parse(pattern), False) > MAX_FILTER_FAN_OUT:
+            raise ValueError('regex must not contain more than one unbounded repeat such as .* or +')
+        return FilterRegex(re.compile(pattern))
+    except re.error as e:
+        raise ValueError(f'Invalid regex: {e}')
+
+
+def line_severity(line):
+    """ Classify a log line (bytes or str) as "error", "warning" or "info" from its wording.
+        piaware does not log a level, so this is a keyword heuristic.
+
+    """
+    if isinstance(line, str):
+        error_regex, warning_regex = _error_str_regex, _warning_str_regex
+    else:
+        error_regex, warning_regex = _error_regex, _warning_regex
+
+    if error_regex.search(line):
+        return 'error'
+    if warning_regex.search(line):
+        return 'warning'
+
+    return 'info'
+
+
+def line_timestamp(line, year):
+    """ Returns the time of a syslog line as seconds since the epoch, or None if it has no timestamp.
+
+        Handles RFC 3339 timestamps and the traditional "Mon dd hh:mm:ss" format, which has no year
+        and is in local time.
+    """
+    match = _rfc3339_regex.match(line)
+    if match:
+        fraction = float(match.group(7)) if match.group(7) else 0.0
+        offset = match.group(8)
+        try:
+            dt = datetime(*(int(match.group(i)) for i in range(1, 7)))
+        except ValueError:
+            return None
+
+        if offset is None:
+            return time.mktime(dt.timetuple()) + fraction
+
+        if offset == b'Z':
+            seconds = 0
+        else:
+            offset = offset.replace(b':', b'')
+            seconds = (int(offset[1:3]) * 60 + int(offset[3:5])) * 60
+            if offset[:1] == b'-':
+                seconds = -seconds
+
+        return dt.replace(tzinfo=timezone.utc).timestamp() - seconds + fraction
+
+    match = _traditional_regex.match(line)
+    if match:
+        month = _months.get(match.group(1))
+        if month is None:
+            return None
+        try:
+            return time.mktime((year, month, int(match.group(2)), int(match.group(3)),
+                                int(match.group(4)), int(match.group(5)), 0, 0, -1))
+        except (OverflowError, ValueError):
+            return None
+
+    return None
+
+
+class _LogFile:
+    """ One of piaware.log and its rotated siblings
+
+    """
+    def __init__(self, path, st):
+        self.path = path
+        self.inode = st.st_ino
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.compressed = path.endswith('.gz')
+
+    @property
+    def year(self):
+        # Traditional syslog timestamps have no year; assume the year the file was last written
+        return time.localtime(self.mtime).tm_year
+
+
+class _FileIndex:
+    """ Sparse index of resume points into one log file.
+
+        Each checkpoint is (line offset, time of the last line before it, compressed offset,
+        decompressor state, buffered partial line). The last three are only used for gzip files,
+        where they allow decompression to resume mid-file instead of from the start.
+    """
+    def __init__(self):
+        self.interval = INDEX_INTERVAL
+        self.checkpoints = []
+
+    def next_offset(self):
+        return self.checkpoints[-1][0] + self.interval if self.checkpoints else self.interval
+
+    def add(self, checkpoint):
+        if checkpoint[0] < self.next_offset():
+            return
+
+        self.checkpoints.append(checkpoint)
+        if len(self.checkpoints) > INDEX_MAX_CHECKPOINTS:
+            # Keep memory bounded for very large files by thinning the index
+            self.checkpoints = self.checkpoints[1::2]
+            self.interval *= 2
+
+    def before_offset(self, offset):
+        best = None
+        for checkpoint in self.checkpoints:
+            if checkpoint[0] > offset:
+                break
+            best = checkpoint
+
+        return best
+
+    def before_time(self, since):
+        best = None
+        for checkpoint in self.checkpoints:
+            if checkpoint[1] is None or checkpoint[1] >= since:
+                break
+            best = checkpoint
+
+        return best
+
+
+class LogHistory:
+    """ Paginated, filtered reads over a log file and its rotated (optionally gzipped) siblings.
+
+        Lines are produced by a chain of generators so memory use does not depend on the size of
+        the logs. Pages are addressed by cursors of the form "<inode>:<offset>", and a sparse
+        per-file index lets deep pages and time-range queries resume near the right place instead
+        of rescanning from the start of the file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._indexes = OrderedDict()
+
+    def log_files(self):
+        """ Returns the log files oldest first
+
+        """
+        directory, name = os.path.split(self.path)
+        rotated = []
+        current = None
+        for entry in os.listdir(directory):
+            if not entry.startswith(name):
+                continue
+
+            path = os.path.join(directory, entry)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+
+            if entry == name:
+                current = _LogFile(path, st)
+                continue
+
+            match = _rotated_regex.match(entry[len(name):])
+            if match:
+                rotated.append((int(match.group(1)), _LogFile(path, st)))
+
+        files = [log_file for _, log_file in sorted(rotated, key=lambda r: r[0], reverse=True)]
+        if current is not None:
+            files.append(current)
+
+        return files
+
+    def _index(self, log_file):
+        key = (log_file.inode, log_file.compressed)
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None and index.checkpoints and index.checkpoints[-1][0] > log_file.size and not log_file.compressed:
+                # Truncated in place; the old checkpoints no longer apply
+                index = None
+
+            if index is None:
+                index = _FileIndex()
+                self._indexes[key] = index
+
+            self._indexes.move_to_end(key)
+            while len(self._indexes) > INDEX_MAX_FILES:
+                self._indexes.popitem(last=False)
+
+        return index
+
+    def _read_plain(self, log_file, index, offset):
+        with open(log_file.path, 'rb') as f:
+            f.seek(offset)
+            last_line = None
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Still being written; it will be picked up by a later page
+                    break
+                if offset >= index.next_offset() and last_line is not None:
+                    index.add((offset, line_timestamp(last_line, log_file.year), None, None, None))
+                yield offset, line
+                offset += len(line)
+                last_line = line
+
+    def _read_gzip(self, log_file, index, offset):
+        checkpoint = index.before_offset(offset)
+        with open(log_file.path, 'rb') as f:
+            if checkpoint is not None:
+                line_offset, _, raw_pos, decompressor, buffered = checkpoint
+                decompressor = decompressor.copy()
+                f.seek(raw_pos)
+            else:
+                line_offset, raw_pos, decompressor, buffered = 0, 0, zlib.decompressobj(zlib.MAX_WBITS | 16), b''
+
+            last_line = None
+            while True:
+                chunk = f.read(READ_CHUNK_BYTES)
+                if not chunk:
+                    break
+                raw_pos += len(chunk)
+
+                data = decompressor.decompress(chunk)
+                # Concatenated gzip members
+                while decompressor.eof and decompressor.unused_data:
+                    unused = decompressor.unused_data
+                    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                    data += decompressor.decompress(unused)
+
+                buffered += data
+                end = buffered.rfind(b'\n') + 1
+                if end == 0:
+                    continue
+
+                for line in buffered[:end].splitlines(keepends=True):
+                    if line_offset >= offset:
+                        yield line_offset, line
+                    line_offset += len(line)
+                    last_line = line
+                buffered = buffered[end:]
+
+                if line_offset >= index.next_offset():
+                    index.add((line_offset, line_timestamp(last_line, log_file.year),
+                               raw_pos, decompressor.copy(), buffered))
+
+            if buffered and line_offset >= offset:
+                yield line_offset, buffered
+
+    def _read_lines(self, log_file, offset):
+        """ Yields (offset, line) for every line of log_file starting at offset
+
+        """
+        index = self._index(log_file)
+        if log_file.compressed:
+            return self._read_gzip(log_file, index, offset)
+
+        return self._read_plain(log_file, index, offset)
+
+    def _start_offset(self, log_file, since):
+        if since is None:
+            return 0
+
+        checkpoint = self._index(log_file).before_time(since)
+        return checkpoint[0] if checkpoint is not None else 0
+
+    def _positions(self, cursor, since):
+        """ Returns the files to read and the offset to start at in the first one
+
+        """
+        files = self.log_files()
+        if cursor is None:
+            if since is not None:
+                # A file's mtime is the time of its last line, so whole files older than since can be skipped
+                while len(files) > 1 and files[0].mtime < since:
+                    files.pop(0)
+            if not files:
+                return [], 0
+            return files, self._start_offset(files[0], since)
+
+        try:
+            inode, offset = (int(part) for part in cursor.split(':'))
+        except ValueError:
+            raise LogCursorError("Invalid cursor")
+
+        for i, log_file in enumerate(files):
+            if log_file.inode == inode:
+                return files[i:], offset
+
+        raise LogCursorError("Cursor has expired")
+
+    def _scan(self, files, offset, since, until, state):
+        """ Yields (time, line) for the lines of files, starting at offset in the first file, that fall
+            within since..until. Lines without a timestamp are treated as having the time of the line
+            before them. state['next_cursor'] is kept pointing just after the last line yielded.
+
+        """
+        scanned = 0
+        for log_file in files:
+            state['next_cursor'] = f'{log_file.inode}:{offset}'
+            last_timestamp = None
+            for line_offset, line in self._read_lines(log_file, offset):
+                scanned += 1
+                if scanned > PAGE_MAX_SCANNED_LINES:
+                    state['complete'] = False
+                    return
+                if scanned % 10000 == 0:
+                    # Let other greenlets run during long scans
+                    time.sleep(0)
+
+                timestamp = line_timestamp(line, log_file.year)
+                if timestamp is None:
+                    timestamp = last_timestamp
+                last_timestamp = timestamp
+
+                if until is not None and timestamp is not None and timestamp > until:
+                    return
+
+                state['next_cursor'] = f'{log_file.inode}:{line_offset + len(line)}'
+                if since is not None and (timestamp is None or timestamp < since):
+                    continue
+
+                yield timestamp, line
+            offset = 0
+
+    def page(self, cursor=None, since=None, until=None, pattern=None, level=None, limit=PAGE_LINES):
+        """ Returns a generator of JSON text for one page of matching lines:
+
+            {"lines": [{"time": ..., "level": ..., "line": ...}, ...], "next_cursor": "...", "complete": bool}
+
+            complete is false if there may be more matching lines after next_cursor. Raises
+            LogCursorError if the cursor is malformed or refers to a file that no longer exists.
+        """
+        files, offset = self._positions(cursor, since)
+        min_level = SEVERITY_LEVELS.index(level) if level else 0
+
+        def generate():
+            state = {'next_cursor': cursor, 'complete': True}
+            matched = 0
+
+            yield '{"lines": ['
+            for timestamp, line in self._scan(files, offset, since, until, state):
+                if pattern is not None and not pattern.search(line):
+                    continue
+
+                severity = line_severity(line)
+                if SEVERITY_LEVELS.index(severity) < min_level:
+                    continue
+
+                item = {'time': timestamp, 'level': severity,
+                        'line': line.decode('utf-8', errors='replace').rstrip('\n')}
+                yield (', ' if matched else '') + json.dumps(item)
+
+                matched += 1
+                if matched >= limit:
+                    state['complete'] = False
+                    break
+
+            yield f'], "next_cursor": {json.dumps(state["next_cursor"])}, "complete": {json.dumps(state["complete"])}}}'
+
+        return generate()
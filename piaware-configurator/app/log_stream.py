@@ -0,0 +1,539 @@
+from collections import deque
+from functools import lru_cache, partial
+import os
+from threading import Lock
+
+from . import inotify
+from .log_history import compile_filter_regex, line_severity, SEVERITY_LEVELS
+
+PIAWARE_LOG_FILE = '/var/log/piaware.log'
+
+# Number of lines of backlog sent to a client when it subscribes, unless it asks for a different
+# number (up to BACKLOG_MAX_LINES)
+BACKLOG_LINES = 200
+BACKLOG_MAX_LINES = 2000
+
+# Block size used when scanning backwards from the end of the log for the backlog
+TAIL_BLOCK_BYTES = 32*1024
+
+# Maximum number of bytes read from the log in one go
+READ_CHUNK_BYTES = 256*1024
+
+# When following the log with inotify, re-check the file anyway after this many idle seconds
+INOTIFY_IDLE_TIMEOUT = 60
+
+# Batched delivery (log_batch event): lines are coalesced for this many seconds after a change,
+# and each batch carries at most LOG_BATCH_MAX_LINES lines / LOG_BATCH_MAX_BYTES bytes
+LOG_BATCH_WINDOW = 0.05
+LOG_BATCH_MAX_LINES = 500
+LOG_BATCH_MAX_BYTES = 64*1024
+
+# A batch client may have this many unacknowledged batches outstanding. Lines that arrive while
+# it is behind wait in a per-client queue of LOG_QUEUE_MAX_LINES; the oldest are dropped beyond that.
+LOG_BATCH_MAX_IN_FLIGHT = 2
+LOG_QUEUE_MAX_LINES = 2000
+
+# The log directory is only watched for the log being created, rotated or deleted, so writes to
+# the other logs there do not wake the tailer. Writes are watched on the log file itself.
+_DIRECTORY_WATCH_MASK = (inotify.IN_CREATE | inotify.IN_MOVED_TO | inotify.IN_MOVED_FROM | inotify.IN_DELETE)
+_FILE_WATCH_MASK = inotify.IN_MODIFY
+
+
+class _BatchSubscriber:
+    """ Delivery state for a client receiving log_batch events
+
+    """
+    def __init__(self, sid):
+        self.sid = sid
+        self.queue = deque()
+        self.in_flight = 0
+        self.dropped = 0
+
+
+@lru_cache(maxsize=64)
+def _compile(pattern):
+    return compile_filter_regex(pattern)
+
+
+class LogFilter:
+    """ Server-side filter for the live log stream. A line must contain substring, match regex and
+        be at least severity for every criterion that is set.
+
+        Raises ValueError for an invalid or refused regex (see compile_filter_regex) or severity.
+    """
+    def __init__(self, substring=None, regex=None, severity=None):
+        if severity is not None and severity not in SEVERITY_LEVELS:
+            raise ValueError(f'severity must be one of {", ".join(SEVERITY_LEVELS)}')
+
+        self.pattern = _compile(regex) if regex else None
+
+        self.substring = substring or None
+        self.regex = regex or None
+        self.severity = severity
+        self._min_level = SEVERITY_LEVELS.index(severity) if severity else 0
+        self.key = (self.substring, self.regex, self.severity)
+        self.seen = 0
+        self.matched = 0
+
+    def is_empty(self):
+        return self.key == (None, None, None)
+
+    def select(self, lines):
+        """ Returns the lines that pass the filter
+
+        """
+        selected = [line for line in lines
+                    if (self.substring is None or self.substring in line)
+                    and (self.pattern is None or self.pattern.search(line))
+                    and (not self._min_level or SEVERITY_LEVELS.index(line_severity(line)) >= self._min_level)]
+        self.seen += len(lines)
+        self.matched += len(selected)
+
+        return selected
+
+    def stats(self):
+        return {'substring': self.substring, 'regex': self.regex, 'severity': self.severity,
+                'seen': self.seen, 'matched': self.matched,
+                'match_rate': round(self.matched / self.seen, 4) if self.seen else None}
+
+
+class _FilterGroup:
+    """ Subscribers that share the same filter. The filter is applied once per group and legacy
+        (log_data) members share a room.
+
+    """
+    def __init__(self, log_filter, room):
+        self.filter = log_filter
+        self.room = room
+        self.members = set()
+        self.batch_subscribers = {}
+
+    def select(self, lines):
+        if self.filter is None:
+            return lines
+
+        return self.filter.select(lines)
+
+
+class LogTailer:
+    """ Follows a log file in a single background task and broadcasts new lines to a Socket.IO room.
+
+        The task is started when the first client subscribes and stops after the last one leaves,
+        so the file is read once no matter how many clients are connected. The log directory is
+        watched with inotify when available so new lines are sent as soon as they are written,
+        otherwise the file is polled every poll_interval seconds. Rotation (inode change) and
+        truncation are detected and the tailer continues on the new file.
+
+        Clients receive one log_data event per line by default. Clients that subscribe with
+        batch=True instead receive log_batch events, {"lines": [...], "dropped": n}, and must
+        acknowledge each one; a client that falls behind has its oldest queued lines dropped
+        and the number dropped is reported in its next batch.
+
+        Clients may also subscribe with a LogFilter. Subscribers with equal filters are grouped so
+        each distinct filter is evaluated once per line, and only matching lines are sent. New
+        lines are matched without holding the tailer's lock.
+    """
+    def __init__(self, socketio, logger, path, room, poll_interval=3):
+        self.socketio = socketio
+        self.logger = logger
+        self.path = path
+        self.room = room
+        self.poll_interval = poll_interval
+        self._lock = Lock()
+        self._subscribers = {}
+        self._groups = {}
+        self._group_count = 0
+        self.dropped_lines = 0
+        self._generation = 0
+        self._running = False
+        self._fd = None
+        self._inode = None
+        self._pos = 0
+        # sids subscribed while _run matches lines outside the lock, or None when it is not
+        self._late_subscribers = None
+
+    def subscribe(self, sid, batch=False, backlog_lines=BACKLOG_LINES, log_filter=None):
+        """ Send the last backlog_lines lines of the log (that pass log_filter) to sid and start
+            streaming new lines to it.
+
+            Subscribing an already subscribed sid only switches its delivery mode and filter.
+        """
+        if log_filter is not None and log_filter.is_empty():
+            log_filter = None
+
+        with self._lock:
+            if sid in self._subscribers:
+                if (batch, log_filter.key if log_filter is not None else None) != self._subscription(sid):
+                    self._place(sid, batch, log_filter)
+                return
+
+            self._place(sid, batch, log_filter)
+            if self._late_subscribers is not None:
+                self._late_subscribers.add(sid)
+            try:
+                if self._fd is None:
+                    self._open(at_end=True)
+                backlog_lines = max(0, min(backlog_lines, BACKLOG_MAX_LINES))
+                lines = tail_lines(self._fd, self._pos, backlog_lines)
+                self._send_lines_to(sid, _decode_lines(lines))
+            except Exception:
+                self.logger.error(f"Error reading {self.path}")
+                self._send_lines_to(sid, [f"Error reading {self.path}..."], apply_filter=False)
+
+            if not self._running:
+                self._running = True
+                self._generation += 1
+                self.socketio.start_background_task(self._run, self._generation)
+                self.logger.debug(f"Started tailer for {self.path}")
+
+    def unsubscribe(self, sid):
+        """ Stop streaming to sid. The tailer stops once no subscribers are left.
+
+        """
+        with self._lock:
+            self._remove(sid)
+
+            if not self._subscribers and self._running:
+                self._running = False
+                self._generation += 1
+                self._close()
+                self.logger.debug(f"Stopping tailer for {self.path}")
+
+    def subscription(self, sid):
+        """ Returns whether sid gets batches and its LogFilter (None if unfiltered). An unknown
+            sid gets the defaults: per-line log_data events, unfiltered.
+
+        """
+        with self._lock:
+            group = self._subscribers.get(sid)
+            if group is None:
+                return False, None
+
+            return sid in group.batch_subscribers, group.filter
+
+    def _subscription(self, sid):
+        group = self._subscribers[sid]
+        return sid in group.batch_subscribers, group.filter.key if group.filter is not None else None
+
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def stats(self):
+        return {'subscribers': len(self._subscribers),
+                'batch_subscribers': sum(len(group.batch_subscribers) for group in self._groups.values()),
+                'dropped_lines': self.dropped_lines,
+                'filters': [dict(group.filter.stats(), subscribers=len(group.members))
+                            for group in self._groups.values() if group.filter is not None]}
+
+    def _place(self, sid, batch, log_filter):
+        """ Put sid in the group for log_filter, as a batch or log_data subscriber
+
+        """
+        self._remove(sid)
+
+        key = log_filter.key if log_filter is not None else None
+        group = self._groups.get(key)
+        if group is None:
+            if key is None:
+                room = self.room
+            else:
+                self._group_count += 1
+                room = f'{self.room}:{self._group_count}'
+            group = _FilterGroup(log_filter, room)
+            self._groups[key] = group
+
+        group.members.add(sid)
+        if batch:
+            group.batch_subscribers[sid] = _BatchSubscriber(sid)
+        else:
+            self.socketio.server.enter_room(sid, group.room, namespace='/')
+        self._subscribers[sid] = group
+
+    def _remove(self, sid):
+        group = self._subscribers.pop(sid, None)
+        if group is None:
+            return
+
+        group.members.discard(sid)
+        if group.batch_subscribers.pop(sid, None) is None:
+            self.socketio.server.leave_room(sid, group.room, namespace='/')
+
+        if not group.members:
+            del self._groups[group.filter.key if group.filter is not None else None]
+
+    def _open(self, at_end):
+        fd = os.open(self.path, os.O_RDONLY | os.O_CLOEXEC)
+        st = os.fstat(fd)
+        self._close()
+        self._fd = fd
+        self._inode = st.st_ino
+        self._pos = 0
+        if at_end and st.st_size > 0:
+            # Start after the last complete line so a line being written is streamed in full
+            start = max(0, st.st_size - TAIL_BLOCK_BYTES)
+            block = os.pread(fd, st.st_size - start, start)
+            end = block.rfind(b'\n') + 1
+            self._pos = start + end if end else st.st_size
+
+    def _close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._inode = None
+
+    def _send_lines_to(self, sid, lines, apply_filter=True):
+        group = self._subscribers[sid]
+        if apply_filter:
+            lines = group.select(lines)
+
+        subscriber = group.batch_subscribers.get(sid)
+        if subscriber is not None:
+            self._queue_lines(subscriber, lines)
+        else:
+            for line in lines:
+                self.socketio.emit('log_data', line, room=sid)
+
+    def _broadcast(self, lines, apply_filter=True):
+        if not lines:
+            return
+
+        for group in self._groups.values():
+            selected = group.select(lines) if apply_filter else lines
+
+            for line in selected:
+                self.socketio.emit('log_data', line, room=group.room)
+
+            for subscriber in group.batch_subscribers.values():
+                self._queue_lines(subscriber, selected)
+
+    def _deliver(self, selections):
+        """ Send each (group, lines) selected by _run to the group's members. Groups that have
+            since emptied are skipped, as are clients that subscribed while the lines were being
+            matched, since their backlog already included them.
+
+        """
+        late = self._late_subscribers
+        for group, selected in selections:
+            if self._groups.get(group.filter.key if group.filter is not None else None) is not group:
+                continue
+
+            for line in selected:
+                self.socketio.emit('log_data', line, room=group.room, skip_sid=list(late) or None)
+
+            for sid, subscriber in group.batch_subscribers.items():
+                if sid not in late:
+                    self._queue_lines(subscriber, selected)
+
+    def _queue_lines(self, subscriber, lines):
+        """ Send lines to a batch subscriber, keeping whatever it has no window for queued and
+            dropping the oldest queued lines beyond LOG_QUEUE_MAX_LINES
+
+        """
+        subscriber.queue.extend(lines)
+        self._flush(subscriber)
+
+        overflow = len(subscriber.queue) - LOG_QUEUE_MAX_LINES
+        if overflow > 0:
+            for _ in range(overflow):
+                subscriber.queue.popleft()
+            subscriber.dropped += overflow
+            self.dropped_lines += overflow
+
+    def _flush(self, subscriber):
+        """ Send queued lines to a batch subscriber while it has acknowledgement window left
+
+        """
+        while subscriber.queue and subscriber.in_flight < LOG_BATCH_MAX_IN_FLIGHT:
+            lines = []
+            size = 0
+            while subscriber.queue and len(lines) < LOG_BATCH_MAX_LINES and size < LOG_BATCH_MAX_BYTES:
+                line = subscriber.queue.popleft()
+                lines.append(line)
+                size += len(line)
+
+            batch = {'lines': lines, 'dropped': subscriber.dropped}
+            subscriber.dropped = 0
+            subscriber.in_flight += 1
+            self.socketio.server.emit('log_batch', batch, room=subscriber.sid, namespace='/',
+                                      callback=partial(self._ack, subscriber))
+
+    def _ack(self, subscriber, *args):
+        with self._lock:
+            subscriber.in_flight -= 1
+            group = self._subscribers.get(subscriber.sid)
+            if group is not None and group.batch_subscribers.get(subscriber.sid) is subscriber:
+                self._flush(subscriber)
+
+    def _run(self, generation):
+        ''' Wait for the log to change and broadcast any new lines to the room
+
+        '''
+        watcher = None
+        if inotify.is_available():
+            try:
+                watcher = inotify.InotifyWatcher()
+                watcher.add_watch(os.path.dirname(self.path), _DIRECTORY_WATCH_MASK)
+            except OSError as e:
+                self.logger.info(f"Could not watch {self.path} with inotify, polling instead: {e}")
+                if watcher is not None:
+                    watcher.close()
+                watcher = None
+
+        name = os.path.basename(self.path)
+        file_wd = self._watch_file(watcher, None) if watcher is not None else None
+        error_reported = False
+        try:
+            while True:
+                with self._lock:
+                    if generation != self._generation:
+                        break
+
+                    try:
+                        lines = self._read_new_lines()
+                        error_reported = False
+                    except Exception:
+                        lines = []
+                        if not error_reported:
+                            self.logger.error(f"Error reading {self.path}")
+                            self._broadcast([f"Error reading {self.path}..."], apply_filter=False)
+                            error_reported = True
+
+                    groups = list(self._groups.values()) if lines else []
+                    if groups:
+                        self._late_subscribers = set()
+
+                if groups:
+                    # Match each group's filter without holding the lock, letting other greenlets
+                    # run between groups, so one slow filter does not hold up the other clients
+                    selections = []
+                    for group in groups:
+                        selections.append((group, group.select(lines)))
+                        self.socketio.sleep(0)
+
+                    with self._lock:
+                        if generation == self._generation:
+                            self._deliver(selections)
+                        self._late_subscribers = None
+
+                if watcher is None:
+                    # Check for new data every poll_interval seconds
+                    self.socketio.sleep(self.poll_interval)
+                    continue
+
+                # Sleep until something happens to the log file (or the watch queue overflowed)
+                while generation == self._generation:
+                    events = watcher.read_events(timeout=INOTIFY_IDLE_TIMEOUT)
+                    if not events:
+                        break
+                    if any(event_name == name or mask & inotify.IN_Q_OVERFLOW for _, mask, event_name in events):
+                        # The log was created, rotated or deleted: move the write watch to the new file
+                        file_wd = self._watch_file(watcher, file_wd)
+                        break
+                    if any(path == self.path for path, _, _ in events):
+                        break
+
+                # Give a burst of writes a moment to land so batch clients get fewer, larger messages
+                if any(group.batch_subscribers for group in self._groups.values()):
+                    self.socketio.sleep(LOG_BATCH_WINDOW)
+        finally:
+            if watcher is not None:
+                watcher.close()
+
+    def _watch_file(self, watcher, wd):
+        """ Watch the current log file for writes, replacing the watch wd on a previous file.
+            Returns the new watch descriptor, or None while the log does not exist.
+
+        """
+        if wd is not None:
+            try:
+                watcher.rm_watch(wd)
+            except OSError:
+                pass
+
+        try:
+            return watcher.add_watch(self.path, _FILE_WATCH_MASK)
+        except OSError:
+            return None
+
+    def _drain(self):
+        """ Read complete lines from the open file starting at the current position
+
+        """
+        lines = []
+        while True:
+            data = os.pread(self._fd, READ_CHUNK_BYTES, self._pos)
+            end = data.rfind(b'\n') + 1
+            if end == 0:
+                # Leave partial lines in the file until the rest of the line has been written,
+                # unless a whole chunk went by without a new line
+                if len(data) == READ_CHUNK_BYTES:
+                    end = len(data)
+                else:
+                    break
+            lines.extend(data[:end].splitlines(keepends=True))
+            self._pos += end
+            if len(data) < READ_CHUNK_BYTES:
+                break
+
+        return lines
+
+    def _read_new_lines(self):
+        if self._fd is None:
+            self._open(at_end=False)
+
+        lines = self._drain()
+
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            # Rotated away and not recreated yet; keep the old file open until it is
+            return _decode_lines(lines)
+
+        if st.st_ino != self._inode:
+            # The file was rotated. Everything written to the old file has been drained above,
+            # including any unterminated last line, so continue from the start of the new file.
+            tail = os.pread(self._fd, READ_CHUNK_BYTES, self._pos)
+            if tail:
+                lines.append(tail)
+            self._open(at_end=False)
+            lines.extend(self._drain())
+        elif st.st_size < self._pos:
+            # The file was truncated in place (copytruncate)
+            self._pos = 0
+            lines.extend(self._drain())
+
+        return _decode_lines(lines)
+
+
+def tail_lines(fd, end_pos, count, block_size=TAIL_BLOCK_BYTES):
+    """ Returns the last count complete lines before end_pos in the open file fd.
+
+        Scans backwards from end_pos one block at a time until enough new lines have been
+        seen, so the cost depends on the size of the lines returned rather than the file.
+        end_pos must be at the start of a line.
+    """
+    if count <= 0 or end_pos <= 0:
+        return []
+
+    blocks = []
+    newlines = 0
+    pos = end_pos
+    # Unless we reach the start of the file, the first line seen is partial, so one extra
+    # new line is needed to be sure of count complete lines
+    while pos > 0 and newlines <= count:
+        size = min(block_size, pos)
+        pos -= size
+        block = os.pread(fd, size, pos)
+        blocks.append(block)
+        newlines += block.count(b'\n')
+
+    blocks.reverse()
+    lines = b''.join(blocks).splitlines(keepends=True)
+    if pos > 0:
+        lines = lines[1:]
+
+    return lines[-count:]
+
+
+def _decode_lines(lines):
+    return [line.decode('utf-8', errors="replace") for line in lines]
@@ -1,39 +1,81 @@
 from datetime import datetime
-from flask import Flask, request, jsonify, make_response, abort, send_file
+from flask import Flask, Response, request, jsonify, make_response, abort
 from flask_cors import CORS
 from flask_socketio import SocketIO, join_room, leave_room
+from werkzeug.exceptions import RequestEntityTooLarge
 from http import HTTPStatus
+import json
 import logging
-from threading import Lock
+import os
+import time
 
-import tohil
 from . import message_handlers
+from . import netstats
 from . import wifi_helpers
+from .batch import batch_runner, MAX_BATCH_REQUESTS
+from .config_cache import piaware_config_snapshot, pending_network_config_snapshot
+from .device_state import device_state_gatherer
+from .jobs import job_manager
+from .probe_cache import network_probe_cache
+from .log_history import LogHistory, LogCursorError, compile_filter_regex, parse_time, PAGE_LINES, PAGE_MAX_LINES, SEVERITY_LEVELS
+from .log_stream import LogTailer, LogFilter, PIAWARE_LOG_FILE, BACKLOG_LINES
+from .status_cache import piaware_status_file, flightfeeder_status_file
+from .metrics_store import MetricsStore, METRICS_STORE_FILE, METRIC_FIELDS, TIERS, status_metrics
+from .status_stream import StatusWatcher
+from .tcl import tcl_executor
+from .throughput import ThroughputSampler, HISTORY_SAMPLES, SAMPLE_INTERVAL
 
 APP_NAME = 'piaware-configurator'
 
+# Largest request body accepted, with plenty of room for a full batch of config writes
+MAX_REQUEST_BYTES = 64 * 1024
+
 app = Flask(__name__)
 CORS(app)
 app.url_map.strict_slashes = False
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
 
 socketio = SocketIO(app, cors_allowed_origins="*")
-log_thread=None
-stop_thread = False
-client_states = {}
-state_lock = Lock()
+piaware_log_tailer = LogTailer(socketio, app.logger, PIAWARE_LOG_FILE, 'piaware_log')
+piaware_log_history = LogHistory(PIAWARE_LOG_FILE)
+status_watcher = StatusWatcher(socketio, app.logger, {'piaware': piaware_status_file, 'flightfeeder': flightfeeder_status_file})
+throughput_sampler = ThroughputSampler(socketio, app.logger)
+status_metrics_store = MetricsStore(METRICS_STORE_FILE, app.logger)
+job_manager.init_app(socketio, app.logger)
 
 @app.before_first_request
 def before_first_request_func():
     """ Initialization of Tcl package dependencies and logger
 
     """
-    tohil.eval('package require fa_piaware_config')
-    tohil.eval('catch {package require fa_flightfeeder_config}')
-    tohil.eval('package require fa_sudo')
-    tohil.eval('package require fa_sysinfo')
-    tohil.eval('::fa_piaware_config::new_combined_config piawareConfig')
-    tohil.eval('catch {::fa_flightfeeder_config::flightfeeder_combined_config flightfeederConfig}')
-    tohil.eval('catch {::fa_flightfeeder_config::flightfeeder_volatile_network_config flightfeederNetworkConfig}')
+    tcl_executor.eval('package require fa_piaware_config')
+    tcl_executor.eval('catch {package require fa_flightfeeder_config}')
+    tcl_executor.eval('package require fa_sudo')
+    tcl_executor.eval('package require fa_sysinfo')
+    tcl_executor.eval('::fa_piaware_config::new_combined_config piawareConfig')
+    tcl_executor.eval('catch {::fa_flightfeeder_config::flightfeeder_combined_config flightfeederConfig}')
+    tcl_executor.eval('catch {::fa_flightfeeder_config::flightfeeder_volatile_network_config flightfeederNetworkConfig}')
+
+def start_background_tasks():
+    """ Start the samplers that record history whether or not any client is connected, so
+        there is data from the time before the first request. Called once at startup.
+
+    """
+    throughput_sampler.start()
+    status_metrics_store.open()
+    status_watcher.add_listener(record_status_metrics)
+
+def record_status_metrics(source, status):
+    """ Status watcher listener that records status.json fields in the metrics store
+
+        Only one source is recorded so fields are not mixed or counted twice: the FlightFeeder
+        status.json where it exists, the same precedence get_device_state uses, otherwise piaware's.
+    """
+    if source == 'piaware' and os.path.exists(flightfeeder_status_file.path):
+        return
+
+    t = status['time'] / 1000 if isinstance(status.get('time'), (int, float)) else None
+    status_metrics_store.record(status_metrics(status), t)
 
 @app.errorhandler(404)
 def not_found_error(error):
@@ -65,14 +107,110 @@ def system_status():
         system_time_utc_str = None
 
     try:
-        total_tx_bytes, total_rx_bytes = wifi_helpers.get_transfer_rate_statistics()
+        interfaces = netstats.get_network_stats()
+        total_tx_bytes, total_rx_bytes = wifi_helpers.get_transfer_rate_statistics(interfaces)
+        interface_bytes = {name: {'tx_bytes': stats['tx_bytes'], 'rx_bytes': stats['rx_bytes']}
+                           for name, stats in interfaces.items()}
     except:
         app.logger.error('Error retrieving networking transfer rate statistics')
-        total_tx_bytes = total_rx_bytes = None
+        total_tx_bytes = total_rx_bytes = interface_bytes = None
 
     response['system_time'] = system_time_utc_str
     response['total_tx_bytes'] = total_tx_bytes
     response['total_rx_bytes'] = total_rx_bytes
+    response['interfaces'] = interface_bytes
+
+    return make_response(jsonify(response), 200)
+
+@app.route('/system/throughput', methods=["GET"])
+def system_throughput():
+    """Endpoint to report current and historical network throughput per interface, in bits per second
+
+    Query parameters (all optional):
+        window     - seconds of history to return (default one hour, at most one week)
+        resolution - seconds per history point (default the sample interval)
+    """
+    window = request.args.get('window', 3600, type=int)
+    resolution = request.args.get('resolution', SAMPLE_INTERVAL, type=int)
+    if window < 0 or resolution <= 0:
+        response = {'success': False, 'error': 'window and resolution must be positive'}
+        return make_response(jsonify(response), HTTPStatus.BAD_REQUEST)
+
+    window = min(window, HISTORY_SAMPLES * SAMPLE_INTERVAL)
+    history, resolution = throughput_sampler.history(window, resolution)
+
+    interfaces = throughput_sampler.current()
+    for name, rates in interfaces.items():
+        rates['history'] = history.get(name, [])
+
+    response = {'interval': SAMPLE_INTERVAL, 'resolution': resolution, 'interfaces': interfaces}
+
+    return make_response(jsonify(response), 200)
+
+@app.route('/system/history', methods=["GET"])
+def system_history():
+    """Endpoint to report min/max/avg series of status.json fields recorded over time
+
+    Query parameters (all optional):
+        since, until - time range, as seconds since the epoch or ISO 8601 (default the last hour)
+        resolution   - minute or hour (default minute for windows up to a day, hour otherwise)
+        fields       - comma separated fields to return (default all)
+    """
+    args = request.args
+    try:
+        until = parse_time(args['until']) if 'until' in args else time.time()
+        since = parse_time(args['since']) if 'since' in args else until - 3600
+    except ValueError:
+        response = {'success': False, 'error': 'since and until must be epoch seconds or ISO 8601 times'}
+        return make_response(jsonify(response), HTTPStatus.BAD_REQUEST)
+
+    tiers = [name for name, _, _ in TIERS]
+    resolution = args.get('resolution', 'minute' if until - since <= 86400 else 'hour')
+    if resolution not in tiers:
+        response = {'success': False, 'error': f'resolution must be one of {", ".join(tiers)}'}
+        return make_response(jsonify(response), HTTPStatus.BAD_REQUEST)
+
+    fields = args['fields'].split(',') if args.get('fields') else METRIC_FIELDS
+    unknown = [field for field in fields if field not in METRIC_FIELDS]
+    if unknown:
+        response = {'success': False, 'error': f'Unknown fields: {", ".join(unknown)}'}
+        return make_response(jsonify(response), HTTPStatus.BAD_REQUEST)
+
+    response = {'resolution': resolution, 'series': status_metrics_store.query(since, until, resolution, fields)}
+
+    return make_response(jsonify(response), 200)
+
+@app.route('/jobs/<job_id>', methods=["GET"])
+def job_status(job_id):
+    """Endpoint to poll a restart or reboot job
+
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        return make_response(jsonify(success=False, error="Unknown job"), 404)
+
+    return make_response(jsonify(job.to_dict()), 200)
+
+@app.route('/system/metrics', methods=["GET"])
+def system_metrics():
+    """Endpoint to report internal cache and performance counters
+
+    """
+    response = dict()
+    response['piaware_config_cache'] = piaware_config_snapshot.stats()
+    response['pending_network_config_cache'] = pending_network_config_snapshot.stats()
+    response['piaware_log'] = piaware_log_tailer.stats()
+    response['piaware_status_cache'] = piaware_status_file.stats()
+    response['flightfeeder_status_cache'] = flightfeeder_status_file.stats()
+    response['status_subscribers'] = status_watcher.subscriber_count()
+    response['device_state'] = device_state_gatherer.stats()
+    response['network_probe_cache'] = network_probe_cache.stats()
+    response['tcl'] = tcl_executor.stats()
+    response['jobs'] = job_manager.stats()
+    response['batch'] = batch_runner.stats()
+    response['status_metrics_store'] = status_metrics_store.stats()
+    response['wifi_scan_results'] = wifi_helpers.wifi_scan_results.stats()
+    response['wifi_live_scans'] = wifi_helpers.scan_wifi_networks.stats()
 
     return make_response(jsonify(response), 200)
 
@@ -81,10 +219,8 @@ def piaware_status():
     """Endpoint to read piaware status.json if it exists
 
     """
-
-    file_path = "/var/run/piaware/status.json"
     try:
-        return send_file(file_path, mimetype='application/json')
+        return status_file_response(piaware_status_file)
     except FileNotFoundError:
         response = {'error': 'Could not read PiAware status.json'}
         return make_response(jsonify(response), 404)
@@ -94,14 +230,79 @@ def flightfeeder_status():
     """Endpoint to read flightfeeder status.json if it exists
 
     """
-
-    file_path = "/var/run/flightfeeder/status.json"
     try:
-        return send_file(file_path, mimetype='application/json')
+        return status_file_response(flightfeeder_status_file)
     except FileNotFoundError:
         response = {'error': 'Could not read FlightFeeder status.json'}
         return make_response(jsonify(response), 404)
 
+def status_file_response(status_file):
+    """ Build a cacheable response for a status.json file. Conditional requests whose ETag or
+        Last-Modified still match get a 304 Not Modified.
+
+    """
+    snapshot = status_file.get()
+
+    response = make_response(snapshot.data)
+    response.mimetype = 'application/json'
+    response.set_etag(snapshot.etag)
+    response.last_modified = snapshot.mtime
+    response.cache_control.max_age = snapshot.max_age()
+
+    return response.make_conditional(request)
+
+@app.route('/piaware/log', methods=["GET"])
+def piaware_log():
+    """Endpoint to page through piaware.log and its rotated siblings
+
+    Query parameters (all optional):
+        since, until - time range, as seconds since the epoch or ISO 8601
+        q            - regular expression lines must match
+        level        - minimum severity: info, warning or error
+        limit        - maximum number of lines to return
+        cursor       - next_cursor from the previous page
+    """
+    args = request.args
+    try:
+        since = parse_time(args['since']) if 'since' in args else None
+        until = parse_time(args['until']) if 'until' in args else None
+    except ValueError:
+        response = {'success': False, 'error': 'since and until must be epoch seconds or ISO 8601 times'}
+        return make_response(jsonify(response), HTTPStatus.BAD_REQUEST)
+
+    try:
+        pattern = compile_filter_regex(args['q'].encode('utf-8')) if args.get('q') else None
+    except ValueError as e:
+        response = {'success': False, 'error': str(e)}
+        return make_response(jsonify(response), HTTPStatus.BAD_REQUEST)
+
+    level = args.get('level')
+    if level is not None and level not in SEVERITY_LEVELS:
+        response = {'success': False, 'error': f'level must be one of {", ".join(SEVERITY_LEVELS)}'}
+        return make_response(jsonify(response), HTTPStatus.BAD_REQUEST)
+
+    try:
+        limit = int(args.get('limit', PAGE_LINES))
+        if limit < 1:
+            raise ValueError
+    except ValueError:
+        response = {'success': False, 'error': 'limit must be a positive integer'}
+        return make_response(jsonify(response), HTTPStatus.BAD_REQUEST)
+    limit = min(limit, PAGE_MAX_LINES)
+
+    try:
+        page = piaware_log_history.page(cursor=args.get('cursor'), since=since, until=until,
+                                        pattern=pattern, level=level, limit=limit)
+    except LogCursorError as e:
+        response = {'success': False, 'error': str(e)}
+        return make_response(jsonify(response), HTTPStatus.BAD_REQUEST)
+    except OSError:
+        app.logger.error('Error reading piaware logs')
+        response = {'success': False, 'error': 'Could not read piaware logs'}
+        return make_response(jsonify(response), 404)
+
+    return Response(page, mimetype='application/json')
+
 @socketio.on('connect')
 def handle_connect():
     ''' Socketio connect event
@@ -109,77 +310,84 @@ def handle_connect():
     '''
     join_room(request.sid)
 
-    with state_lock:
-        if request.sid not in client_states:
-            client_states[request.sid] = {'log_thread': None, 'stop_thread': False}
+    # Clients can ask for batched log delivery with ?batch=1, a backlog size with ?lines=N
+    # and a filter with ?substring=...&regex=...&severity=...
+    args = request.args
+    batch = args.get('batch', '').lower() in ('1', 'true', 'yes')
+    backlog_lines = args.get('lines', BACKLOG_LINES, type=int)
+    try:
+        log_filter = LogFilter(args.get('substring'), args.get('regex'), args.get('severity'))
+    except ValueError as e:
+        app.logger.info(f'Ignoring invalid log filter: {e}')
+        log_filter = None
+
+    piaware_log_tailer.subscribe(request.sid, batch=batch, backlog_lines=backlog_lines, log_filter=log_filter)
+    app.logger.info(f'Accepted client connection')
+
+@socketio.on('log_subscribe')
+def handle_log_subscribe(options):
+    ''' Socketio event to change how the piaware log is streamed to this client
+
+        Expected options format (all keys optional; a key that is left out keeps its current
+        setting, and a null or empty filter removes the filter):
+        {
+            "batch": true,
+            "filter": {"substring": "mlat", "regex": "^.*(fail|error)", "severity": "warning"}
+        }
+    '''
+    if not isinstance(options, dict):
+        return {"success": False, "error": "Options must be a dict"}
+
+    batch, log_filter = piaware_log_tailer.subscription(request.sid)
+
+    if 'batch' in options:
+        batch = bool(options['batch'])
+
+    if 'filter' in options:
+        filter_options = options['filter'] or {}
+        if not isinstance(filter_options, dict):
+            return {"success": False, "error": "filter must be a dict"}
+
+        try:
+            log_filter = LogFilter(filter_options.get('substring'), filter_options.get('regex'), filter_options.get('severity'))
+        except ValueError as e:
+            return {"success": False, "error": str(e)}
+
+    piaware_log_tailer.subscribe(request.sid, batch=batch, log_filter=log_filter)
+    return {"success": True}
 
-        if client_states[request.sid]['log_thread'] is None:
-            # Create a thread for that client
-            client_states[request.sid]['log_thread'] = socketio.start_background_task(stream_piaware_log_file, request.sid)
-            app.logger.info(f'Accepted client connection')
+@socketio.on('status_subscribe')
+def handle_status_subscribe():
+    ''' Socketio event to start receiving status events for piaware and flightfeeder status.json
+
+    '''
+    status_watcher.subscribe(request.sid)
+    return {"success": True}
+
+@socketio.on('status_unsubscribe')
+def handle_status_unsubscribe():
+    ''' Socketio event to stop receiving status events
+
+    '''
+    status_watcher.unsubscribe(request.sid)
+    return {"success": True}
 
 @socketio.on('disconnect')
 def handle_disconnect():
     ''' Socketio disconnect event
 
     '''
-    with state_lock:
-        if request.sid in client_states:
-            client_states[request.sid]['log_thread'] = None
-            client_states[request.sid]['stop_thread'] = True
-            del client_states[request.sid]
+    piaware_log_tailer.unsubscribe(request.sid)
+    status_watcher.unsubscribe(request.sid)
 
     leave_room(request.sid)
     app.logger.info(f'Client disconnected')
 
-def stream_piaware_log_file(client_sid):
-    ''' Streams piaware.log by periodically reading the file and emitting the data via a web socket.
-        This will periodically seek to EOF to determine if there are new lines to be read.
-
-    '''
-    app.logger.debug("Spawned thread to follow piaware logs")
-    curr_pos = 0
-    try:
-        while True:
-            if client_sid in client_states and client_states[client_sid]['stop_thread']:
-                break
-            # Open file for reading
-            with open('/var/log/piaware.log', 'rb') as f:
-                # Seek EOF position
-                f.seek(0,2)
-                end_pos = f.tell()
-
-                # Skip the current position ahead for the initial read to avoid reading the entire file
-                if curr_pos == 0:
-                    curr_pos = max(curr_pos, (end_pos - 200*160))
-
-                    # Read forward until next new line in case we land in the middle of a line
-                    f.seek(curr_pos)
-                    while True:
-                        char = f.read(1)
-                        curr_pos += 1
-                        if not char or char == b'\n':
-                            break
-
-                # If EOF is greater than our current position, this indicates new log data.
-                # Emit all the new lines up to end of file and update the current_position
-                if end_pos > curr_pos:
-                    f.seek(curr_pos)
-                    for line in f:
-                        socketio.emit('log_data', line.decode('utf-8', errors="replace"), room=client_sid)
-                        socketio.sleep(0)
-                    curr_pos = f.tell()
-
-            # Check for new data every 3 seconds
-            socketio.sleep(3)
-    except:
-        app.logger.error("Error reading piaware.log")
-        socketio.emit('log_data', "Error reading piaware.log...", room=client_sid)
-
 
 def validate_json(request):
     """Validate request to ensure it is json
 
+    The body is size checked before it is read, then decoded and parsed once.
     Return the json data if valid
     """
 
@@ -190,8 +398,21 @@ def validate_json(request):
                                  HTTPStatus.UNSUPPORTED_MEDIA_TYPE)
         abort(response)
 
+    # Check size before reading the body, and again after in case no Content-Length was sent
     try:
-        _ = request.data.decode("utf-8")
+        if request.content_length is not None and request.content_length > MAX_REQUEST_BYTES:
+            raise RequestEntityTooLarge()
+        data = request.get_data(cache=False)
+        if len(data) > MAX_REQUEST_BYTES:
+            raise RequestEntityTooLarge()
+    except RequestEntityTooLarge:
+        response = make_response(jsonify(success=False,
+                                 error=f"Request body must be at most {MAX_REQUEST_BYTES} bytes"),
+                                 HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        abort(response)
+
+    try:
+        text = data.decode("utf-8")
     except UnicodeDecodeError:
         response = make_response(jsonify(sucess=False,
                                  error="Data must be UTF-8 encoded"),
@@ -199,13 +420,18 @@ def validate_json(request):
         abort(response)
 
     # Check for valid json
-    if not isinstance(request.get_json(silent=True), dict):
+    try:
+        json_payload = json.loads(text)
+    except ValueError:
+        json_payload = None
+
+    if not isinstance(json_payload, dict):
         response = make_response(jsonify(sucess=False,
                                  error="Invalid json in request"),
                                  HTTPStatus.BAD_REQUEST)
         abort(response)
 
-    return request.get_json()
+    return json_payload
 
 
 def validate_form(request):
@@ -233,43 +459,54 @@ def process_json(json_payload):
         response = make_response(jsonify(success=False, error="Missing request field"), HTTPStatus.BAD_REQUEST)
         abort(response)
 
-    app.logger.info(f'Incoming request: {request}')
-    app.logger.debug(f'{json_payload}')
-    if request == 'piaware_config_read':
-        json_response, status_code = message_handlers.handle_read_config_request(json_payload)
-    elif request == 'piaware_config_write':
-        json_response, status_code = message_handlers.handle_write_config_request(json_payload)
-    elif request == 'get_device_info':
-        json_response, status_code = message_handlers.handle_get_device_info_request()
-    elif request == 'get_device_state':
-        json_response, status_code = message_handlers.handle_get_device_state_request()
-    elif request == 'get_network_info':
-        json_response, status_code = message_handlers.handle_get_network_info()
-    elif request == 'get_wifi_networks':
-        json_response, status_code = message_handlers.handle_get_wifi_networks_request()
-    elif request == 'set_wifi_config':
-        json_response, status_code = message_handlers.handle_set_wifi_config_request(json_payload)
-    elif request == 'restart_receiver':
-        json_response, status_code = message_handlers.handle_restart_receiver_request()
-    elif request == 'restart_network':
-        json_response, status_code = message_handlers.handle_restart_network_request()
-    elif request == 'reboot':
-        json_response, status_code = message_handlers.handle_reboot_request()
-    elif request == 'get_pending_network_config':
-        json_response, status_code = message_handlers.handle_read_pending_network_config_request(json_payload)
-    elif request == 'set_pending_network_config':
-        json_response, status_code = message_handlers.handle_write_pending_network_config_request(json_payload)
-    elif request == 'save_pending_network_settings':
-        json_response, status_code = message_handlers.handle_save_pending_network_settings()
-    elif request == 'delete_pending_network_settings':
-        json_response, status_code = message_handlers.handle_delete_pending_network_settings()
+    if request == 'batch':
+        json_response, status_code = process_batch(json_payload)
+    else:
+        json_response, status_code = dispatch_request(request, json_payload)
+
+    return make_response(jsonify(json_response), status_code)
+
+
+def process_batch(json_payload):
+    """ Run the sub-requests of a batch envelope and return one result for each
+
+    Expected json_payload format:
+    {
+        "request": "batch",
+        "requests": [{"request": "get_device_info"}, {"request": "get_network_info"}]
+    }
+    """
+    requests = json_payload.get('requests')
+    if type(requests) is not list or not requests:
+        return {"success": False, "error": "requests must be a non-empty list"}, HTTPStatus.BAD_REQUEST
+
+    if len(requests) > MAX_BATCH_REQUESTS:
+        return {"success": False, "error": f"At most {MAX_BATCH_REQUESTS} requests per batch"}, HTTPStatus.BAD_REQUEST
+
+    app.logger.info('Incoming batch of %d requests', len(requests))
+
+    return {"success": True, "responses": batch_runner.run(requests, dispatch_request)}, HTTPStatus.OK
+
+
+def dispatch_request(request, json_payload):
+    """ Call the piaware-config handler function for a single request
+
+    Returns the response dict and HTTP status code
+    """
+    # Let the logger format messages only when their level is enabled
+    app.logger.info('Incoming request: %s', request)
+    app.logger.debug('%s', json_payload)
+    # Requests that are not strings (lists, objects) cannot be looked up and are not supported
+    handler = message_handlers.REQUEST_HANDLERS.get(request) if isinstance(request, str) else None
+    if handler is not None:
+        json_response, status_code = handler.dispatch(json_payload)
     else:
         app.logger.error(f'Unrecognized request: {request}')
         json_response, status_code = {"success": False, "error": "Unsupported request"}, HTTPStatus.BAD_REQUEST
 
-    app.logger.debug(f'Response: {json_response}')
+    app.logger.debug('Response: %s', json_response)
 
-    return make_response(jsonify(json_response), status_code)
+    return json_response, status_code
 
 
 class ContextFilter(logging.Filter):
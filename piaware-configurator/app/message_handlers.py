@@ -1,12 +1,16 @@
 from flask import current_app
 from http import HTTPStatus
-import json
 import os
 import subprocess
 
 from .piaware_config_helpers import *
-from .flightfeeder_config_helpers import get_pending_network_config, set_pending_network_config
-from .wifi_helpers import get_wifi_networks, scan_wifi_networks, parse_wifi_networks
+from .flightfeeder_config_helpers import get_pending_network_config, set_pending_network_configs
+from .wifi_helpers import get_wifi_networks, scan_wifi_networks, parse_wifi_networks, wifi_scan_results, \
+                          mark_wifi_scan_activity, request_wifi_scan, wait_for_wifi_scan
+from .device_state import device_state_gatherer
+from .dispatch import PayloadSchema, RequestHandler
+from .jobs import job_manager
+from . import netstats
 
 API_VERSION = '2.0.0'
 
@@ -20,24 +24,17 @@ def handle_read_config_request(config_request):
             "request_payload" : ["rtlsdr-gain"]
         }
 
-        request_payload must be a list of config settings to read
+        request_payload must be a list of config settings to read. It is checked against
+        READ_SETTINGS_SCHEMA before the handler runs.
     """
     try:
-        read_settings = config_request['request_payload']
-        if type(read_settings) is not list:
-            raise TypeError
-
         response = {}
-        for config in read_settings:
+        for config in config_request['request_payload']:
             value = get_piaware_config(config)
             response[config] = value
 
         response["success"] = True
         json_response, status_code = response, HTTPStatus.OK
-    except KeyError:
-        json_response, status_code = {"success": False, "error": "Missing request_payload field"}, HTTPStatus.BAD_REQUEST
-    except TypeError:
-        json_response, status_code = {"success": False, "error": "Request_payload must be a list of settings to read"}, HTTPStatus.BAD_REQUEST
     except PiAwareConfigPermissionException as e:
         error = f"Reading {e.setting} is not allowed"
         json_response, status_code = {"success": False, "error": error}, HTTPStatus.OK
@@ -59,7 +56,8 @@ def handle_read_pending_network_config_request(config_request):
             "request_payload" : ["wireless-network", "wireless-ssid"]
         }
 
-        request_payload must be a list of config settings to read
+        request_payload must be a list of config settings to read. It is checked against
+        READ_SETTINGS_SCHEMA before the handler runs.
     """
     filename = "/run/flightfeeder-volatile-config.txt"
 
@@ -67,21 +65,13 @@ def handle_read_pending_network_config_request(config_request):
         return {"success": False, "error": "No pending settings exist"}, 404
 
     try:
-        read_settings = config_request['request_payload']
-        if type(read_settings) is not list:
-            raise TypeError
-
         response = {}
-        for config in read_settings:
+        for config in config_request['request_payload']:
             value = get_pending_network_config(config)
             response[config] = value
 
         response["success"] = True
         json_response, status_code = response, HTTPStatus.OK
-    except KeyError:
-        json_response, status_code = {"success": False, "error": "Missing request_payload field"}, HTTPStatus.BAD_REQUEST
-    except TypeError:
-        json_response, status_code = {"success": False, "error": "Request_payload must be a list of settings to read"}, HTTPStatus.BAD_REQUEST
     except PiAwareConfigPermissionException as e:
         error = f"Reading {e.setting} is not allowed"
         json_response, status_code = {"success": False, "error": error}, HTTPStatus.OK
@@ -103,24 +93,18 @@ def handle_write_config_request(config_request):
             "request_payload" : {"rtlsdr-gain": 20, "wireless-network": "no"}
         }
 
-        request_payload must be a dictionary of key/value configuration setting pairs
+        request_payload must be a dictionary of key/value configuration setting pairs. It is
+        checked against WRITE_SETTINGS_SCHEMA before the handler runs.
     """
     try:
         write_settings = config_request['request_payload']
-        if type(write_settings) is not dict:
-            raise TypeError
-
-        updated_settings = {}
-        for config, value in write_settings.items():
-            set_piaware_config(config, value)
-            updated_settings[config] = value
+        changed, timings = set_piaware_configs(write_settings)
+        updated_settings = dict(write_settings)
 
         json_response, status_code = updated_settings, HTTPStatus.OK
         json_response["success"] = True
-    except KeyError:
-        json_response, status_code = {"success": False, "error": "Missing request_payload field"}, HTTPStatus.BAD_REQUEST
-    except TypeError:
-        json_response, status_code = {"success": False, "error": "request_payload must be a dict"}, HTTPStatus.BAD_REQUEST
+        json_response["changed"] = changed
+        json_response["timings_ms"] = timings
     except PiAwareConfigPermissionException as e:
         error = f"Setting {e.setting} is not allowed"
         json_response, status_code = {"success": False, "error": error}, HTTPStatus.OK
@@ -142,7 +126,8 @@ def handle_write_pending_network_config_request(config_request):
             "request_payload" : {"wireless-ssid": "MyWifiNetwork", "wireless-address": "192.168.0.111"}
         }
 
-        request_payload must be a dictionary of key/value configuration setting pairs
+        request_payload must be a dictionary of key/value configuration setting pairs. It is
+        checked against WRITE_SETTINGS_SCHEMA before the handler runs.
     """
     filename = "/run/flightfeeder-volatile-config.txt"
 
@@ -153,20 +138,13 @@ def handle_write_pending_network_config_request(config_request):
 
     try:
         write_settings = config_request['request_payload']
-        if type(write_settings) is not dict:
-            raise TypeError
-
-        updated_settings = {}
-        for config, value in write_settings.items():
-            set_pending_network_config(config, value)
-            updated_settings[config] = value
+        changed, timings = set_pending_network_configs(write_settings)
+        updated_settings = dict(write_settings)
 
         json_response, status_code = updated_settings, HTTPStatus.OK
         json_response["success"] = True
-    except KeyError:
-        json_response, status_code = {"success": False, "error": "Missing request_payload field"}, HTTPStatus.BAD_REQUEST
-    except TypeError:
-        json_response, status_code = {"success": False, "error": "request_payload must be a dict"}, HTTPStatus.BAD_REQUEST
+        json_response["changed"] = changed
+        json_response["timings_ms"] = timings
     except PiAwareConfigPermissionException as e:
         error = f"Setting {e.setting} is not allowed"
         json_response, status_code = {"success": False, "error": error}, HTTPStatus.OK
@@ -201,39 +179,37 @@ def handle_get_device_info_request():
     return json_response, status_code
 
 
-def handle_get_device_state_request():
+def handle_get_device_state_request(config_request=None):
     """ Returns a dictionary of device settings
 
+        The lookups run concurrently. Sources that are too slow or fail are answered with their
+        last known value and listed in "stale_sources". Per-source timings are included when
+        requested with:
+        {
+            "request": "get_device_state",
+            "timings": true
+        }
     """
     try:
+        values, stale, timings = device_state_gatherer.gather()
+
         # read piaware-config settings for wifi credentials
-        wireless_ssid = get_piaware_config('wireless-ssid')
-        wireless_country = get_piaware_config('wireless-country')
+        wireless_ssid, wireless_country = values['wireless_config']
         # Hardcoded for now since we removed read permissions for wireless-password. Unused by clients but
         # still need the key present for this API version
         wireless_password_set = True
 
         # Check route to FlightAware and IP address via fa_sysinfo pakage and tohil
-        route_to_flightaware, ip_address, interface = get_network_state_and_ip()
+        route_to_flightaware, ip_address, interface = values['route']
         is_connected_to_internet = True if route_to_flightaware and not ip_address.startswith("169.254") else False
 
-        device_location = get_device_location()
-        unique_feeder_id = get_unique_feederid()
-
-        is_claimed = False
-        is_connected_to_FA = None
-        site_id = None
-
-        flightfeeder_status_file = '/var/run/flightfeeder/status.json'
-        piaware_status_file = '/var/run/piaware/status.json'
+        device_location = values['location']
+        unique_feeder_id = values['feeder_id']
 
-        if os.path.exists(flightfeeder_status_file):
-            with open(flightfeeder_status_file) as f:
-                status_json = json.load(f)
+        status_source, status_json = values['status_json']
+        if status_source == 'flightfeeder':
             is_claimed = True
-        elif os.path.exists(piaware_status_file):
-            with open(piaware_status_file) as f:
-                status_json = json.load(f)
+        else:
             is_claimed = bool(unique_feeder_id) and is_receiver_claimed(status_json)
 
         is_connected_to_FA = is_connected_to_flightaware(status_json)
@@ -249,8 +225,11 @@ def handle_get_device_state_request():
                         'feeder_id': unique_feeder_id,
                         'site_id': site_id,
                         'network_interface': interface,
-                        'device_location': device_location
+                        'device_location': device_location,
+                        'stale_sources': stale
                         }
+        if config_request and config_request.get('timings') is True:
+            json_response['timings_ms'] = timings
         status_code = HTTPStatus.OK
 
     except PiAwareConfigException as e:
@@ -263,9 +242,12 @@ def handle_get_device_state_request():
     return json_response, status_code
 
 
-def handle_get_wifi_networks_request():
+def handle_get_wifi_networks_request(config_request=None):
     """Returns a dictionary of visible wireless networks and relevant information
 
+    Send {"request": "get_wifi_networks", "rescan": true} to wait for a fresh scan instead of
+    getting the latest results.
+
     Example return data:
     {
         "wifi_networks": [
@@ -282,20 +264,60 @@ def handle_get_wifi_networks_request():
             "is_5Ghz": True,
             "signal": -40,
             "wifi_cell": "02"
-        }]
+        }],
+        "generation": 12,
+        "scan_time": 1693969799.2
     }
+
+    generation and scan_time are only present when the results come from piaware-wifi-scan's
+    available_wifi_networks.json. If piaware-wifi-scan is running but has no results after WIFI_SCAN_WAIT
+    seconds, the last results are returned, or an empty list if there are none yet.
     """
     try:
         current_app.logger.debug(f'Getting wifi networks...')
-        iw_list_data = get_wifi_networks()
-
-        # Do an actual scan if something went wrong getting it from wifi_scan script
-        if iw_list_data == "":
-            current_app.logger.info(f'Scanning for wifi networks...')
-            iw_list_data = scan_wifi_networks()
-
+        rescan = bool(config_request) and config_request.get('rescan') is True
         wifi_networks = {}
-        wifi_networks['wifi_networks'] = parse_wifi_networks(iw_list_data)
+
+        # Keeps piaware-wifi-scan scanning frequently while someone is configuring wifi
+        mark_wifi_scan_activity()
+
+        try:
+            scan_results = wifi_scan_results.get()
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            current_app.logger.error(f'Error reading wifi scan results: {e}')
+            scan_results = None
+
+        scanner_running = False
+        if scan_results is None or rescan:
+            scanner_running = request_wifi_scan()
+            if scanner_running:
+                current_app.logger.info(f'Waiting for wifi scan...')
+                generation = scan_results[1] if scan_results is not None else -1
+                scan_results = wait_for_wifi_scan(generation) or scan_results
+            elif rescan:
+                # piaware-wifi-scan is not running
+                scan_results = None
+
+        if scan_results is not None:
+            networks, generation, scan_time = scan_results
+            wifi_networks['wifi_networks'] = networks
+            wifi_networks['generation'] = generation
+            wifi_networks['scan_time'] = scan_time
+        elif scanner_running:
+            # piaware-wifi-scan is still scanning. A second scan here would only fail with
+            # "Device or resource busy", so answer with no networks and let the client ask again.
+            current_app.logger.info(f'Timed out waiting for wifi scan')
+            wifi_networks['wifi_networks'] = []
+        else:
+            # Fall back to the raw iwlist output piaware-wifi-scan also writes
+            iw_list_data = "" if rescan else get_wifi_networks()
+
+            # Do an actual scan if something went wrong getting it from piaware-wifi-scan
+            if iw_list_data == "":
+                current_app.logger.info(f'Scanning for wifi networks...')
+                iw_list_data = scan_wifi_networks()
+
+            wifi_networks['wifi_networks'] = parse_wifi_networks(iw_list_data)
 
         json_response, status_code = wifi_networks, HTTPStatus.OK
     except Exception as e:
@@ -318,30 +340,28 @@ def handle_set_wifi_config_request(config_request):
         }
     }
 
+    The network is only restarted when a setting changed, so resending the current settings
+    does not drop the connection again. Add "restart": true to restart it anyway, for example
+    to retry after a restart that failed.
+
     """
     try:
-        wifi_credentials = config_request['request_payload']
+        write_settings = dict(config_request['request_payload'])
+        if "requestor" in config_request and config_request["requestor"] == "piaware-ble-connect":
+           current_app.logger.info(f'Setting WiFi configuration over Bluetooth. Setting allow-ble-setup to "yes".')
+           write_settings["allow-ble-setup"] = "yes"
 
-        if type(wifi_credentials) is not dict:
-            raise TypeError
+        changed, timings = set_piaware_configs(write_settings)
 
-        for config, value in wifi_credentials.items():
-            set_piaware_config(config, value)
+        json_response, status_code = {"success": True, "changed": changed, "timings_ms": timings}, HTTPStatus.OK
 
-        if "requestor" in config_request and config_request["requestor"] == "piaware-ble-connect":
-           current_app.logger.info(f'Setting WiFi configuration over Bluetooth. Setting allow-ble-setup to "yes".')
-           set_piaware_config("allow-ble-setup", "yes")
-
-        current_app.logger.info(f'Restarting network...')
-        tohil.eval('::fa_sudo::popen_as -root -- /usr/bin/piaware-restart-network')
-
-        json_response, status_code = {"success": True}, HTTPStatus.OK
-    except KeyError:
-        json_response, status_code = {"success": False, "error": "Missing payload in request"}, HTTPStatus.BAD_REQUEST
-    except TypeError:
-        json_response, status_code = {"success": False, "error": "Invalid JSON format"}, HTTPStatus.BAD_REQUEST
-    except subprocess.CalledProcessError:
-        json_response, status_code = {"success": False, "error": "Error restarting network"}, HTTPStatus.OK
+        # Nothing to apply if the client resent the current settings, unless it asked to retry
+        if changed or config_request.get('restart') is True:
+            current_app.logger.info(f'Restarting network...')
+            job = submit_restart_network(settings_changed=bool(changed))
+            json_response["job_id"] = job.id
+        else:
+            current_app.logger.info(f'WiFi configuration unchanged. Not restarting network.')
     except Exception:
         json_response, status_code = {"success": False, "error": "Server error writing config setting"}, HTTPStatus.OK
 
@@ -372,12 +392,13 @@ def handle_get_network_info():
         wired_broadcast = get_piaware_config('wired-broadcast')
         wired_nameservers = get_piaware_config('wired-nameservers')
 
-        # IP address and ethernet/wifi state
-        eth0_ipaddress = tohil.eval('::fa_sysinfo::interface_ip_address eth0', to=str)
-        wlan_interface = tohil.eval('::fa_sysinfo::wireless_interface', to=str)
-        wlan_ipaddress = tohil.eval(f'::fa_sysinfo::interface_ip_address {wlan_interface}', to=str)
-        ethernet_state = tohil.eval('::fa_sysinfo::interface_state eth0', to=str)
-        wifi_state = tohil.eval(f'::fa_sysinfo::interface_state {wlan_interface}', to=str)
+        # IP address and ethernet/wifi state, read from sysfs and netlink for all interfaces at once
+        interfaces = netstats.get_network_stats()
+        wlan_interface = netstats.wireless_interface()
+        eth0_ipaddress = netstats.interface_ip_address(interfaces, 'eth0')
+        wlan_ipaddress = netstats.interface_ip_address(interfaces, wlan_interface)
+        ethernet_state = netstats.interface_state(interfaces, 'eth0')
+        wifi_state = netstats.interface_state(interfaces, wlan_interface)
 
         json_response = {'wireless-network': wireless_network,
                         'wireless-type': wireless_type,
@@ -398,7 +419,8 @@ def handle_get_network_info():
                         'wired-nameservers': wired_nameservers,
                         'eth0-ipaddress': eth0_ipaddress,
                         'wifi-state': wifi_state,
-                        'ethernet-state': ethernet_state
+                        'ethernet-state': ethernet_state,
+                        'interfaces': interfaces
                         }
 
         status_code = HTTPStatus.OK
@@ -411,37 +433,58 @@ def handle_get_network_info():
 
     return json_response, status_code
 
+def _job_response(job):
+    return {"success": True, "job_id": job.id, "state": job.state}, HTTPStatus.OK
+
+
 def handle_restart_receiver_request():
+    """ Queues a job to restart the receiver, or joins one that is queued or running.
+        Returns the job id right away.
+
+    """
     current_app.logger.info(f'Restarting receiver...')
     try:
-        tohil.eval('::fa_sudo::popen_as -root -- /usr/bin/piaware-restart-receiver')
-        json_response, status_code = {"success": True}, HTTPStatus.OK
-    except subprocess.CalledProcessError:
-        json_response, status_code = {"success": False, "error": "Error restarting receiver"}, HTTPStatus.OK
+        json_response, status_code = _job_response(job_manager.submit('restart_receiver'))
     except Exception:
         json_response, status_code = {"success": False, "error": "Server error restarting receiver"}, HTTPStatus.OK
 
     return json_response, status_code
 
 
+def _network_restarted(job):
+    network_probe_cache.invalidate()
+
+
+def submit_restart_network(settings_changed=False):
+    """ Queues a job to restart the network, or joins one that is queued or running. When
+        settings_changed, a running restart may predate the new settings, so it is not joined
+        and a restart is queued to follow it.
+
+    """
+    network_probe_cache.invalidate()
+    return job_manager.submit('restart_network', on_finished=_network_restarted, after_running=settings_changed)
+
+
 def handle_restart_network_request():
+    """ Queues a job to restart the network, or joins one that is queued or running.
+        Returns the job id right away.
+
+    """
     current_app.logger.info(f'Restarting network...')
     try:
-        tohil.eval('::fa_sudo::popen_as -root -- /usr/bin/piaware-restart-network')
-        json_response, status_code = {"success": True}, HTTPStatus.OK
-    except subprocess.CalledProcessError:
-        json_response, status_code = {"success": False, "error": "Error restarting network"}, HTTPStatus.OK
+        json_response, status_code = _job_response(submit_restart_network())
     except Exception:
         json_response, status_code = {"success": False, "error": "Server error restarting network"}, HTTPStatus.OK
 
     return json_response, status_code
 
 def handle_reboot_request():
+    """ Starts a job to reboot the device. Returns the job id right away.
+
+    """
     current_app.logger.info(f'Rebooting device...')
     try:
-        tohil.eval('::fa_sudo::exec_as -root -- /sbin/shutdown -r now')
-    except subprocess.CalledProcessError:
-        json_response, status_code = {"success": False, "error": "Error rebooting device"}, HTTPStatus.OK
+        json_response, status_code = _job_response(job_manager.submit('reboot'))
     except Exception:
         json_response, status_code = {"success": False, "error": "Server error occurred"}, HTTPStatus.OK
 
@@ -451,7 +494,8 @@ def handle_save_pending_network_settings():
     ''' Handler function to save the volatile config settings permanently
 
         This function will write the pending settings to piaware config and remove
-        the volatile config file.
+        the volatile config file. Settings that may not be written are refused before
+        anything is removed, and if the write fails the pending settings are restored.
     '''
     # Read the flightfeeder volatile config settings
     filename = "/run/flightfeeder-volatile-config.txt"
@@ -476,14 +520,32 @@ def handle_save_pending_network_settings():
                 value = ""
             config_dict[config] = value
 
+    # Check every setting before anything is removed, so a rejected setting leaves the pending
+    # settings in place
+    try:
+        validate_settings(config_dict, piaware_config_write_whitelist)
+    except PiAwareConfigAsciiStringException:
+        return {"success": False, "error": "Badly formatted pending setting"}, HTTPStatus.BAD_REQUEST
+    except PiAwareConfigPermissionException as e:
+        return {"success": False, "error": f"Pending setting {e.setting} is not allowed"}, HTTPStatus.BAD_REQUEST
+
     # Remove the flightfeeder-volatile-config.txt file first, otherwise
     # any piaware-config setting will just update this file
     cmd = ["sudo", "rm", filename]
     subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
     # Save settings permanently by writing them to piaware-config
-    for k,v in config_dict.items():
-        set_piaware_config(k, v)
+    try:
+        set_piaware_configs(config_dict)
+    except PiAwareConfigException as e:
+        # Nothing was written, so put the pending settings back for the client to retry
+        try:
+            set_pending_network_configs(config_dict)
+        except PiAwareConfigException:
+            current_app.logger.error('Could not restore the pending network settings')
+        return {"success": False, "error": f"Server error occurred saving pending setting: {e.setting}"}, HTTPStatus.INTERNAL_SERVER_ERROR
+    finally:
+        network_probe_cache.invalidate()
 
     return {"success": True}, 200
 
@@ -501,4 +563,31 @@ def handle_delete_pending_network_settings():
     cmd = ["sudo", "rm", filename]
     subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-    return {"success": True}, 200
\ No newline at end of file
+    return {"success": True}, 200
+
+
+READ_SETTINGS_SCHEMA = PayloadSchema(list, "Request_payload must be a list of settings to read",
+                                     whitelist=piaware_config_read_whitelist,
+                                     not_allowed_error="Reading {} is not allowed")
+WRITE_SETTINGS_SCHEMA = PayloadSchema(dict, "request_payload must be a dict",
+                                      whitelist=piaware_config_write_whitelist,
+                                      not_allowed_error="Setting {} is not allowed")
+WIFI_CONFIG_SCHEMA = PayloadSchema(dict, "Invalid JSON format", missing_error="Missing payload in request")
+
+# Request name -> handler, used by process_json
+REQUEST_HANDLERS = {
+    'piaware_config_read': RequestHandler(handle_read_config_request, READ_SETTINGS_SCHEMA),
+    'piaware_config_write': RequestHandler(handle_write_config_request, WRITE_SETTINGS_SCHEMA),
+    'get_device_info': RequestHandler(handle_get_device_info_request),
+    'get_device_state': RequestHandler(handle_get_device_state_request),
+    'get_network_info': RequestHandler(handle_get_network_info),
+    'get_wifi_networks': RequestHandler(handle_get_wifi_networks_request),
+    'set_wifi_config': RequestHandler(handle_set_wifi_config_request, WIFI_CONFIG_SCHEMA),
+    'restart_receiver': RequestHandler(handle_restart_receiver_request),
+    'restart_network': RequestHandler(handle_restart_network_request),
+    'reboot': RequestHandler(handle_reboot_request),
+    'get_pending_network_config': RequestHandler(handle_read_pending_network_config_request, READ_SETTINGS_SCHEMA),
+    'set_pending_network_config': RequestHandler(handle_write_pending_network_config_request, WRITE_SETTINGS_SCHEMA),
+    'save_pending_network_settings': RequestHandler(handle_save_pending_network_settings),
+    'delete_pending_network_settings': RequestHandler(handle_delete_pending_network_settings),
+}
@@ -0,0 +1,173 @@
+import mmap
+import os
+import struct
+from threading import Lock
+import time
+
+METRICS_STORE_FILE = '/var/lib/piaware-configurator/status_metrics.db'
+
+# status.json fields that are recorded. Component statuses are stored as COLOR_VALUES.
+METRIC_FIELDS = (
+    'cpu_temp_celcius',
+    'cpu_load_percent',
+    'system_uptime',
+    'radio',
+    'adept',
+    'mlat',
+    'piaware',
+    'network',
+)
+
+COLOR_VALUES = {'red': 0, 'amber': 1, 'green': 2}
+
+# Rollup tiers: (name, seconds per record, number of records kept)
+TIERS = (
+    ('minute', 60, 7 * 24 * 60),
+    ('hour', 3600, 365 * 24),
+)
+
+_MAGIC = b'PACM'
+_VERSION = 1
+_HEADER = struct.Struct('<4sHH')
+_HEADER_SIZE = 64
+
+# A record is the bucket start time followed by count, min, max and sum for every field
+_RECORD = struct.Struct('<I' + 'Iffd' * len(METRIC_FIELDS))
+
+
+def _write_header(mapping):
+    _HEADER.pack_into(mapping, 0, _MAGIC, _VERSION, len(METRIC_FIELDS))
+
+
+def status_metrics(status):
+    """ Returns {field: value} for the METRIC_FIELDS present in a parsed status.json
+
+    """
+    values = {}
+    for field in METRIC_FIELDS:
+        value = status.get(field)
+        if isinstance(value, dict):
+            value = COLOR_VALUES.get(value.get('status'))
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[field] = value
+
+    return values
+
+
+class MetricsStore:
+    """ Fixed-size time-series store of status.json fields, rolled up into per-minute and per-hour
+        min/max/avg records in a memory-mapped file.
+
+        Each tier is a ring of fixed-width records indexed by bucket start time, so the file never
+        grows and old buckets are simply overwritten. A record is only used if its stored bucket
+        start matches the bucket being looked up, which also makes a restart or a clock change
+        safe. If the file cannot be opened the store works in anonymous memory instead.
+    """
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+        self._lock = Lock()
+        self._map = None
+        self.persistent = False
+        self.samples = 0
+
+        self._offsets = {}
+        offset = _HEADER_SIZE
+        for name, seconds, slots in TIERS:
+            self._offsets[name] = (offset, seconds, slots)
+            offset += slots * _RECORD.size
+        self.size = offset
+
+    def open(self):
+        with self._lock:
+            if self._map is not None:
+                return
+
+            try:
+                self._map = self._open_file()
+                self.persistent = True
+            except OSError as e:
+                self.logger.warning(f"Could not open {self.path}, keeping status metrics in memory only: {e}")
+                self._map = mmap.mmap(-1, self.size)
+                _write_header(self._map)
+
+    def _open_file(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != self.size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+            mapping = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+
+        magic, version, fields = _HEADER.unpack_from(mapping)
+        if (magic, version, fields) != (_MAGIC, _VERSION, len(METRIC_FIELDS)):
+            # New or incompatible file: start over
+            mapping[:] = bytes(self.size)
+            _write_header(mapping)
+
+        return mapping
+
+    def record(self, values, t=None):
+        """ Add one sample of {field: value} to the current minute and hour records
+
+        """
+        if t is None:
+            t = time.time()
+
+        with self._lock:
+            if self._map is None:
+                return
+
+            for offset, seconds, slots in self._offsets.values():
+                bucket = int(t) // seconds * seconds
+                position = offset + (bucket // seconds % slots) * _RECORD.size
+
+                record = list(_RECORD.unpack_from(self._map, position))
+                if record[0] != bucket:
+                    record = [bucket] + [0, 0.0, 0.0, 0.0] * len(METRIC_FIELDS)
+
+                for i, field in enumerate(METRIC_FIELDS):
+                    value = values.get(field)
+                    if value is None:
+                        continue
+                    base = 1 + i * 4
+                    count, low, high, total = record[base:base + 4]
+                    if count == 0:
+                        low = high = value
+                    record[base:base + 4] = [count + 1, min(low, value), max(high, value), total + value]
+
+                _RECORD.pack_into(self._map, position, *record)
+
+            self.samples += 1
+
+    def query(self, since, until, tier, fields=METRIC_FIELDS):
+        """ Returns {field: [[bucket start, min, max, avg], ...]} for the buckets of a tier that
+            start between since and until. Buckets without samples for a field are left out.
+
+        """
+        offset, seconds, slots = self._offsets[tier]
+        first = max(int(since) // seconds, int(until) // seconds - slots + 1)
+        last = int(until) // seconds
+        indexes = [(i, METRIC_FIELDS.index(field)) for i, field in enumerate(fields)]
+
+        series = {field: [] for field in fields}
+        with self._lock:
+            if self._map is None:
+                return series
+
+            for n in range(first, last + 1):
+                record = _RECORD.unpack_from(self._map, offset + (n % slots) * _RECORD.size)
+                if record[0] != n * seconds:
+                    continue
+                for i, index in indexes:
+                    count, low, high, total = record[1 + index * 4:5 + index * 4]
+                    if count:
+                        series[fields[i]].append([n * seconds, round(low, 3), round(high, 3), round(total / count, 3)])
+
+        return series
+
+    def stats(self):
+        return {'samples': self.samples, 'persistent': self.persistent, 'bytes': self.size}
+
@@ -0,0 +1,183 @@
+import os
+import socket
+import struct
+
+SYS_CLASS_NET = '/sys/class/net'
+
+# Netlink route protocol constants (linux/netlink.h, linux/rtnetlink.h, linux/if_addr.h)
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+RTM_NEWADDR = 20
+RTM_GETADDR = 22
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+
+_NLMSGHDR = struct.Struct('=LHHLL')
+_IFADDRMSG = struct.Struct('=BBBBI')
+_RTATTR = struct.Struct('=HH')
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def _read_sysfs(path, default=""):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+
+def interface_names():
+    """ Returns the names of all network interfaces except loopback
+
+    """
+    try:
+        return sorted(name for name in os.listdir(SYS_CLASS_NET) if name != 'lo')
+    except OSError:
+        return []
+
+
+def is_wireless(name):
+    return os.path.exists(os.path.join(SYS_CLASS_NET, name, 'wireless')) or \
+           os.path.exists(os.path.join(SYS_CLASS_NET, name, 'phy80211'))
+
+
+def is_physical(name):
+    """ Returns whether the interface is backed by a device, as opposed to a bridge, tunnel, etc.
+
+    """
+    return os.path.exists(os.path.join(SYS_CLASS_NET, name, 'device'))
+
+
+def wireless_interface():
+    """ Returns the name of the first wireless interface, or "" if there is none
+
+    """
+    for name in interface_names():
+        if is_wireless(name):
+            return name
+
+    return ""
+
+
+def get_interface_addresses():
+    """ Returns {interface name: {"ipv4": [...], "ipv6": [...]}} for every interface with an
+        address, from a single RTM_GETADDR netlink dump
+
+    """
+    addresses = {}
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE) as sock:
+        sock.bind((0, 0))
+        request = _NLMSGHDR.pack(_NLMSGHDR.size + _IFADDRMSG.size, RTM_GETADDR, NLM_F_REQUEST | NLM_F_DUMP, 1, 0) + \
+                  _IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+        sock.send(request)
+
+        done = False
+        while not done:
+            data = sock.recv(65536)
+            offset = 0
+            while offset + _NLMSGHDR.size <= len(data):
+                msg_len, msg_type, _, _, _ = _NLMSGHDR.unpack_from(data, offset)
+                if msg_len < _NLMSGHDR.size:
+                    done = True
+                    break
+
+                if msg_type == NLMSG_DONE:
+                    done = True
+                    break
+                if msg_type == NLMSG_ERROR:
+                    error, = struct.unpack_from('=i', data, offset + _NLMSGHDR.size)
+                    raise OSError(-error, os.strerror(-error))
+                if msg_type == RTM_NEWADDR:
+                    _parse_address(data[offset + _NLMSGHDR.size:offset + msg_len], addresses)
+
+                offset += _align(msg_len)
+
+    return addresses
+
+
+def _parse_address(payload, addresses):
+    family, _, _, _, index = _IFADDRMSG.unpack_from(payload)
+    if family == socket.AF_INET:
+        key = 'ipv4'
+    elif family == socket.AF_INET6:
+        key = 'ipv6'
+    else:
+        return
+
+    attrs = {}
+    offset = _align(_IFADDRMSG.size)
+    while offset + _RTATTR.size <= len(payload):
+        attr_len, attr_type = _RTATTR.unpack_from(payload, offset)
+        if attr_len < _RTATTR.size:
+            break
+        attrs[attr_type] = payload[offset + _RTATTR.size:offset + attr_len]
+        offset += _align(attr_len)
+
+    # IFA_LOCAL is the interface's own address; IFA_ADDRESS is the peer on point-to-point links
+    address = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+    if address is None:
+        return
+
+    try:
+        name = socket.if_indextoname(index)
+    except OSError:
+        return
+
+    entry = addresses.setdefault(name, {'ipv4': [], 'ipv6': []})
+    entry[key].append(socket.inet_ntop(family, address))
+
+
+def read_byte_counters():
+    """ Returns {interface name: (rx_bytes, tx_bytes)} for every interface except loopback
+
+    """
+    counters = {}
+    for name in interface_names():
+        statistics = os.path.join(SYS_CLASS_NET, name, 'statistics')
+        counters[name] = (int(_read_sysfs(os.path.join(statistics, 'rx_bytes'), 0)),
+                          int(_read_sysfs(os.path.join(statistics, 'tx_bytes'), 0)))
+
+    return counters
+
+
+def get_network_stats():
+    """ Returns {interface name: {...}} with the operational state, transfer counters and
+        addresses of every interface except loopback
+
+    """
+    addresses = get_interface_addresses()
+
+    interfaces = {}
+    for name, (rx_bytes, tx_bytes) in read_byte_counters().items():
+        interfaces[name] = {
+            'operstate': _read_sysfs(os.path.join(SYS_CLASS_NET, name, 'operstate')),
+            'rx_bytes': rx_bytes,
+            'tx_bytes': tx_bytes,
+            'wireless': is_wireless(name),
+            'physical': is_physical(name),
+            'ipv4': addresses.get(name, {}).get('ipv4', []),
+            'ipv6': addresses.get(name, {}).get('ipv6', []),
+        }
+
+    return interfaces
+
+
+def interface_ip_address(interfaces, name):
+    """ Returns the first IPv4 address of an interface from get_network_stats(), or ""
+
+    """
+    addresses = interfaces.get(name, {}).get('ipv4')
+    return addresses[0] if addresses else ""
+
+
+def interface_state(interfaces, name):
+    """ Returns the operational state of an interface from get_network_stats(), or ""
+
+    """
+    return interfaces.get(name, {}).get('operstate', "")
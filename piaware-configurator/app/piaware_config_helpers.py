@@ -1,20 +1,18 @@
 from flask import current_app
-import tohil
+import time
 from .common import *
+from .config_cache import piaware_config_snapshot
+from .probe_cache import network_probe_cache, ROUTE_TTL
+from .tcl import tcl_executor
 
 def get_piaware_config(setting):
     """ Getter function for piaware-config settings
 
     """
-    if not setting.isascii():
-       raise PiAwareConfigAsciiStringException(setting)
-
-    if setting not in piaware_config_read_whitelist:
-       raise PiAwareConfigPermissionException(setting)
+    validate_settings((setting,), piaware_config_read_whitelist)
 
     try:
-        tohil.eval('piawareConfig read_config')
-        value = str(tohil.call('piawareConfig', 'get', setting))
+        value = piaware_config_snapshot.get(setting)
     except Exception:
         current_app.logger.error(f'Error reading {setting}. Make sure {setting} is a valid piaware-config option.')
         raise PiAwareConfigException(setting)
@@ -26,38 +24,54 @@ def set_piaware_config(setting, value):
     """ Setter function for piaware-config settings
 
     """
-    if not setting.isascii():
-       raise PiAwareConfigAsciiStringException(setting)
+    return set_piaware_configs({setting: value})
+
 
-    if setting not in piaware_config_write_whitelist:
-        raise PiAwareConfigPermissionException(setting)
+def set_piaware_configs(settings):
+    """ Batch setter for piaware-config settings. Every setting is validated up front and all of them
+        are persisted with a single write_config, so either all settings are written or none are.
+
+        Settings that already have the requested value are not rewritten. Returns the list of
+        changed settings and a dict of timings in milliseconds
+    """
+    start = time.monotonic()
+    validate_settings(settings, piaware_config_write_whitelist)
+    validate_ms = round((time.monotonic() - start) * 1000, 2)
 
     try:
-        tohil.eval('piawareConfig read_config')
-        tohil.call('piawareConfig', 'set_option', setting, value)
-        tohil.eval('piawareConfig write_config')
-    except Exception:
-        current_app.logger.error(f'Error setting {setting} to {value}. Make sure {setting} is a valid piaware-config option.')
-        raise PiAwareConfigException(setting)
+        changed, timings = piaware_config_snapshot.write(settings)
+    except PiAwareConfigException as e:
+        current_app.logger.error(f'Error writing {e.setting}. Make sure {e.setting} is a valid piaware-config option.')
+        raise
+
+    timings['validate_ms'] = validate_ms
+    current_app.logger.debug('Wrote %d of %d settings: %s', len(changed), len(settings), timings)
 
-    return
+    return changed, timings
 
 def get_network_state_and_ip():
     """ Get the network state by checking if there is a route to FlightAware. Return state and current IP address
 
+        Results are cached for ROUTE_TTL seconds
     """
-    try:
-        route = tohil.eval('::fa_sysinfo::route_to_flightaware gateway iface ip', to=int)
-        if route:
-            route_to_flightaware = True
-            ip_address = tohil.getvar('ip', to=str)
-            interface = tohil.getvar('iface', to=str)
-        else:
-            route_to_flightaware = False
-            ip_address = ""
-            interface = ""
-    except Exception:
-        raise
+    return network_probe_cache.get('route_to_flightaware', _probe_route_to_flightaware, ROUTE_TTL)
+
+
+def _probe_route_to_flightaware():
+    return tcl_executor.run(_route_to_flightaware)
+
+
+def _route_to_flightaware(tohil):
+    # Runs on the Tcl thread, so the ip and iface variables cannot be overwritten in between
+    route = tohil.eval('::fa_sysinfo::route_to_flightaware gateway iface ip', to=int)
+    if route:
+        route_to_flightaware = True
+        ip_address = tohil.getvar('ip', to=str)
+        interface = tohil.getvar('iface', to=str)
+    else:
+        route_to_flightaware = False
+        ip_address = ""
+        interface = ""
 
     return route_to_flightaware, ip_address, interface
 
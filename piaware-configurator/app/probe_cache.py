@@ -0,0 +1,62 @@
+import os
+from threading import Lock
+import time
+
+
+def _env_seconds(name, default):
+    try:
+        return max(0.0, float(os.environ.get(name, default)))
+    except ValueError:
+        return default
+
+
+# Seconds a route_to_flightaware result is reused. Set ROUTE_TTL in /etc/default/piaware-configurator
+# to change it; 0 disables caching.
+ROUTE_TTL = _env_seconds('ROUTE_TTL', 10)
+
+
+class TTLCache:
+    """ Small cache of probe results that expire after a per-entry TTL.
+
+        get() returns the cached value for key if it has not expired, otherwise calls loader()
+        and caches its result. Exceptions from loader() are not cached. invalidate() drops every
+        entry, for use after anything that changes the network configuration.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = {}
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key, loader, ttl):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+
+        value = loader()
+
+        with self._lock:
+            # Do not keep a result probed before an invalidate() that happened while loading
+            if generation == self._generation:
+                self._entries[key] = (time.monotonic() + ttl, value)
+
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self.invalidations += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations, 'entries': len(self._entries)}
+
+
+network_probe_cache = TTLCache()
@@ -0,0 +1,115 @@
+import errno
+import json
+import os
+from threading import Lock
+import time
+
+from .batch import snapshot_pin
+
+PIAWARE_STATUS_FILE = '/var/run/piaware/status.json'
+FLIGHTFEEDER_STATUS_FILE = '/var/run/flightfeeder/status.json'
+
+
+class StatusSnapshot:
+    """ One version of a status.json file: the raw bytes, the parsed dict (None if the file was not
+        valid JSON) and the values needed for HTTP caching
+
+    """
+    def __init__(self, data, st):
+        self.data = data
+        self.mtime = st.st_mtime
+        self.etag = f'{st.st_ino:x}-{st.st_mtime_ns:x}-{st.st_size:x}'
+
+        try:
+            self.status = json.loads(data)
+        except ValueError:
+            self.status = None
+
+    def max_age(self, now=None):
+        """ Seconds until piaware is expected to rewrite the file, based on its time/interval and
+            expiry fields. Returns 0 if that cannot be determined.
+
+        """
+        if not isinstance(self.status, dict):
+            return 0
+
+        if now is None:
+            now = time.time()
+
+        deadlines = []
+        try:
+            deadlines.append((self.status['time'] + self.status['interval']) / 1000)
+        except (KeyError, TypeError):
+            pass
+        try:
+            deadlines.append(self.status['expiry'] / 1000)
+        except (KeyError, TypeError):
+            pass
+
+        if not deadlines:
+            return 0
+
+        return max(0, int(min(deadlines) - now))
+
+
+class StatusFile:
+    """ Cache of a status.json file keyed on its inode, mtime and size.
+
+        The file is read and parsed only when it changes; every other call returns the cached
+        snapshot. get() raises FileNotFoundError if the file does not exist. Within a batch the
+        file is only checked by the first get(), and that snapshot is served for the rest of the
+        batch.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._key = None
+        self._snapshot = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self):
+        pinned = snapshot_pin(self)
+        if pinned:
+            if pinned['snapshot'] is None:
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), self.path)
+            self.hits += 1
+            return pinned['snapshot']
+
+        try:
+            snapshot = self._load()
+        except FileNotFoundError:
+            if pinned is not None:
+                pinned['snapshot'] = None
+            raise
+
+        if pinned is not None:
+            pinned['snapshot'] = snapshot
+
+        return snapshot
+
+    def _load(self):
+        st = os.stat(self.path)
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+
+        with self._lock:
+            if key == self._key:
+                self.hits += 1
+                return self._snapshot
+
+            with open(self.path, 'rb') as f:
+                data = f.read()
+                st = os.fstat(f.fileno())
+
+            self._snapshot = StatusSnapshot(data, st)
+            self._key = (st.st_ino, st.st_mtime_ns, st.st_size)
+            self.misses += 1
+
+            return self._snapshot
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+piaware_status_file = StatusFile(PIAWARE_STATUS_FILE)
+flightfeeder_status_file = StatusFile(FLIGHTFEEDER_STATUS_FILE)
@@ -0,0 +1,184 @@
+import os
+from threading import Lock
+
+from . import inotify
+
+# Poll interval used when the status directories cannot be watched with inotify
+STATUS_POLL_INTERVAL = 5
+
+# When watching with inotify, re-check the status files anyway after this many idle seconds
+INOTIFY_IDLE_TIMEOUT = 60
+
+# Fields that change on every rewrite and are left out of change events
+VOLATILE_FIELDS = frozenset(('time', 'expiry', 'system_uptime'))
+
+_WATCH_MASK = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_CREATE | inotify.IN_DELETE
+
+
+def status_changes(old, new):
+    """ Returns the top-level fields of new that differ from old, ignoring VOLATILE_FIELDS.
+        Fields that were removed are reported as None.
+
+    """
+    changes = {key: value for key, value in new.items()
+               if key not in VOLATILE_FIELDS and old.get(key) != value}
+    changes.update({key: None for key in old
+                    if key not in new and key not in VOLATILE_FIELDS})
+
+    return changes
+
+
+class StatusWatcher:
+    """ Pushes status.json contents to subscribed Socket.IO clients as "status" events.
+
+        A subscriber first gets a full snapshot of every source:
+
+            {"source": "piaware", "full": true, "status": {...}}
+
+        and after that only the fields that changed when a file is rewritten:
+
+            {"source": "piaware", "full": false, "changes": {"mlat": {"status": "green", ...}}}
+
+        One background task watches all the files (with inotify when possible, otherwise by
+        polling) for all subscribers, and runs only while there are subscribers or listeners.
+        Listeners are called with (source, status) every time a status file is rewritten.
+    """
+    def __init__(self, socketio, logger, status_files, room='status'):
+        self.socketio = socketio
+        self.logger = logger
+        self.status_files = status_files
+        self.room = room
+        self._lock = Lock()
+        self._subscribers = set()
+        self._listeners = []
+        self._generation = 0
+        self._running = False
+        self._last = {}
+
+    def subscribe(self, sid):
+        with self._lock:
+            if not self._running:
+                self._last = {source: self._read(status_file) for source, status_file in self.status_files.items()}
+
+            for source, status in self._last.items():
+                self.socketio.emit('status', {'source': source, 'full': True, 'status': status}, room=sid)
+
+            self.socketio.server.enter_room(sid, self.room, namespace='/')
+            self._subscribers.add(sid)
+
+            self._start()
+
+    def add_listener(self, callback):
+        with self._lock:
+            self._listeners.append(callback)
+            self._start()
+
+    def _start(self):
+        if not self._running:
+            self._running = True
+            self._generation += 1
+            self.socketio.start_background_task(self._run, self._generation)
+            self.logger.debug("Started status watcher")
+
+    def unsubscribe(self, sid):
+        with self._lock:
+            if sid not in self._subscribers:
+                return
+
+            self._subscribers.discard(sid)
+            self.socketio.server.leave_room(sid, self.room, namespace='/')
+
+            if not self._subscribers and not self._listeners and self._running:
+                self._running = False
+                self._generation += 1
+                self.logger.debug("Stopping status watcher")
+
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def _read(self, status_file):
+        try:
+            return status_file.get().status
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            self.logger.error(f"Error reading {status_file.path}: {e}")
+            return None
+
+    def _check(self):
+        """ Emit changes for every source whose status differs from what was last sent
+
+        """
+        for source, status_file in self.status_files.items():
+            status = self._read(status_file)
+            last = self._last.get(source)
+            if status == last:
+                continue
+
+            self._last[source] = status
+            if isinstance(status, dict):
+                for listener in self._listeners:
+                    try:
+                        listener(source, status)
+                    except Exception as e:
+                        self.logger.error(f"Error handling {source} status update: {e}")
+
+            if isinstance(status, dict) and isinstance(last, dict):
+                changes = status_changes(last, status)
+                if changes:
+                    self.socketio.emit('status', {'source': source, 'full': False, 'changes': changes}, room=self.room)
+            else:
+                # Appeared, disappeared or became unparseable: send the whole thing
+                self.socketio.emit('status', {'source': source, 'full': True, 'status': status}, room=self.room)
+
+    def _watch(self):
+        """ Returns an inotify watcher on the status file directories, the file names to wait for,
+            and whether every directory could be watched. The watcher is None if none could be.
+
+        """
+        if not inotify.is_available():
+            return None, None, False
+
+        watcher = inotify.InotifyWatcher()
+        names = set()
+        for status_file in self.status_files.values():
+            directory, name = os.path.split(status_file.path)
+            try:
+                watcher.add_watch(directory, _WATCH_MASK)
+                names.add(name)
+            except OSError as e:
+                self.logger.debug(f"Could not watch {directory}: {e}")
+
+        if not names:
+            watcher.close()
+            return None, None, False
+
+        return watcher, names, len(names) == len(self.status_files)
+
+    def _run(self, generation):
+        ''' Wait for status files to change and push the changes to subscribers
+
+        '''
+        watcher, names, complete = self._watch()
+        # A directory that did not exist when the watch was set up (piaware not running yet)
+        # is covered by polling at the usual interval
+        timeout = INOTIFY_IDLE_TIMEOUT if complete else STATUS_POLL_INTERVAL
+        try:
+            while True:
+                with self._lock:
+                    if generation != self._generation:
+                        break
+                    self._check()
+
+                if watcher is None:
+                    self.socketio.sleep(STATUS_POLL_INTERVAL)
+                    continue
+
+                while generation == self._generation:
+                    events = watcher.read_events(timeout=timeout)
+                    if not events or any(name in names or mask & inotify.IN_Q_OVERFLOW
+                                         for _, mask, name in events):
+                        break
+        finally:
+            if watcher is not None:
+                watcher.close()
@@ -0,0 +1,123 @@
+import time
+
+try:
+    import eventlet.patcher
+    import eventlet.tpool
+    threading = eventlet.patcher.original('threading')
+    queue = eventlet.patcher.original('queue')
+except ImportError:
+    eventlet = None
+    import threading
+    import queue
+
+
+class _TclCall:
+    def __init__(self, func):
+        self.func = func
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.submitted = time.monotonic()
+        self.started = None
+        self.finished = None
+
+
+class TclExecutor:
+    """ Runs every Tcl (tohil) call on one dedicated OS thread.
+
+        The embedded Tcl interpreter is not safe to use from several threads, and under the
+        eventlet worker a Tcl call made from a greenlet blocks every other request and Socket.IO
+        stream until it returns. Calls are queued to the Tcl thread instead, and the caller waits
+        for the result through eventlet's thread pool so the hub keeps running. tohil is imported
+        on the Tcl thread so the interpreter belongs to it.
+    """
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.calls = 0
+        self.errors = 0
+        self.max_queue_depth = 0
+        self.total_wait_ms = 0
+        self.max_wait_ms = 0
+        self.total_run_ms = 0
+        self.max_run_ms = 0
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='tcl', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        import tohil
+
+        while True:
+            call = self._queue.get()
+            call.started = time.monotonic()
+            try:
+                call.result = call.func(tohil)
+            except Exception as e:
+                call.error = e
+            call.finished = time.monotonic()
+            call.done.set()
+
+    def run(self, func):
+        """ Run func(tohil) on the Tcl thread and return its result, re-raising its exception.
+            Use this for sequences of calls that must not be interleaved with other callers.
+
+        """
+        if threading.current_thread() is self._thread:
+            import tohil
+            return func(tohil)
+
+        self._start()
+        call = _TclCall(func)
+        self._queue.put(call)
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+        if eventlet is not None and eventlet.patcher.is_monkey_patched('thread'):
+            eventlet.tpool.execute(call.done.wait)
+        else:
+            call.done.wait()
+
+        self._record(call)
+        if call.error is not None:
+            raise call.error
+
+        return call.result
+
+    def _record(self, call):
+        wait_ms = (call.started - call.submitted) * 1000
+        run_ms = (call.finished - call.started) * 1000
+        self.calls += 1
+        self.errors += call.error is not None
+        self.total_wait_ms += wait_ms
+        self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+        self.total_run_ms += run_ms
+        self.max_run_ms = max(self.max_run_ms, run_ms)
+
+    def eval(self, script, **kwargs):
+        return self.run(lambda tohil: tohil.eval(script, **kwargs))
+
+    def call(self, *args, **kwargs):
+        return self.run(lambda tohil: tohil.call(*args, **kwargs))
+
+    def getvar(self, name, **kwargs):
+        return self.run(lambda tohil: tohil.getvar(name, **kwargs))
+
+    def stats(self):
+        calls = max(self.calls, 1)
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'queue_depth': self._queue.qsize(),
+            'max_queue_depth': self.max_queue_depth,
+            'avg_wait_ms': round(self.total_wait_ms / calls, 2),
+            'max_wait_ms': round(self.max_wait_ms, 2),
+            'avg_run_ms': round(self.total_run_ms / calls, 2),
+            'max_run_ms': round(self.max_run_ms, 2),
+        }
+
+
+tcl_executor = TclExecutor()
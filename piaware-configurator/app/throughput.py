@@ -0,0 +1,174 @@
+from array import array
+import math
+from threading import Lock
+import time
+
+from .netstats import read_byte_counters
+
+# Seconds between samples of the interface byte counters
+SAMPLE_INTERVAL = 30
+
+# Samples kept per interface: one week at SAMPLE_INTERVAL
+HISTORY_SAMPLES = 7 * 24 * 3600 // SAMPLE_INTERVAL
+
+# Interfaces tracked at most, so memory stays bounded if interfaces come and go
+MAX_INTERFACES = 8
+
+# Upper bound on the number of points returned by history()
+MAX_HISTORY_POINTS = 1000
+
+
+class CounterRing:
+    """ Fixed-size ring buffer of (time, rx_bytes, tx_bytes) samples for one interface, stored in
+        preallocated arrays: 24 bytes per sample regardless of how many have been recorded.
+
+    """
+    def __init__(self, size):
+        self.size = size
+        self.times = array('d', bytes(8 * size))
+        self.rx = array('Q', bytes(8 * size))
+        self.tx = array('Q', bytes(8 * size))
+        self.count = 0
+        self.head = 0
+
+    def append(self, t, rx_bytes, tx_bytes):
+        self.times[self.head] = t
+        self.rx[self.head] = rx_bytes
+        self.tx[self.head] = tx_bytes
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def samples(self, since=0):
+        """ Yields (time, rx_bytes, tx_bytes) samples taken at or after since, oldest first
+
+        """
+        start = (self.head - self.count) % self.size
+
+        # Samples are appended in time order, so binary search for the first one to return
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.times[(start + middle) % self.size] < since:
+                low = middle + 1
+            else:
+                high = middle
+
+        for i in range(low, self.count):
+            index = (start + i) % self.size
+            yield self.times[index], self.rx[index], self.tx[index]
+
+    def last(self, n):
+        """ Returns the n most recent samples, oldest first
+
+        """
+        n = min(n, self.count)
+        return [(self.times[index], self.rx[index], self.tx[index])
+                for index in ((self.head - n + i) % self.size for i in range(n))]
+
+
+def _rates(samples):
+    """ Yields (time, seconds, rx_bytes, tx_bytes) deltas between consecutive samples. Intervals
+        where a counter went backwards (interface reset) or the clock jumped back are skipped.
+
+    """
+    previous = None
+    for sample in samples:
+        if previous is not None:
+            seconds = sample[0] - previous[0]
+            if seconds > 0 and sample[1] >= previous[1] and sample[2] >= previous[2]:
+                yield sample[0], seconds, sample[1] - previous[1], sample[2] - previous[2]
+        previous = sample
+
+
+class ThroughputSampler:
+    """ Samples the byte counters of every network interface each SAMPLE_INTERVAL seconds into
+        per-interface CounterRings, so rates and history can be served without touching the
+        interfaces on the request path.
+
+    """
+    def __init__(self, socketio, logger, interval=SAMPLE_INTERVAL, history_samples=HISTORY_SAMPLES):
+        self.socketio = socketio
+        self.logger = logger
+        self.interval = interval
+        self.history_samples = history_samples
+        self._lock = Lock()
+        self._rings = {}
+        self._running = False
+
+    def start(self):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+
+        self.socketio.start_background_task(self._run)
+        self.logger.debug("Started throughput sampler")
+
+    def sample(self, now=None):
+        counters = read_byte_counters()
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            for name, (rx_bytes, tx_bytes) in counters.items():
+                ring = self._rings.get(name)
+                if ring is None:
+                    if len(self._rings) >= MAX_INTERFACES:
+                        continue
+                    ring = self._rings[name] = CounterRing(self.history_samples)
+                ring.append(now, rx_bytes, tx_bytes)
+
+    def _run(self):
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                self.logger.error(f"Error sampling interface byte counters: {e}")
+            self.socketio.sleep(self.interval)
+
+    def current(self):
+        """ Returns {interface: {"rx_bps": ..., "tx_bps": ...}} in bits per second over the last
+            sample interval. Rates are None until two samples have been taken.
+
+        """
+        rates = {}
+        with self._lock:
+            for name, ring in self._rings.items():
+                deltas = list(_rates(ring.last(2)))
+                if deltas:
+                    _, seconds, rx_bytes, tx_bytes = deltas[-1]
+                    rates[name] = {'rx_bps': round(rx_bytes * 8 / seconds), 'tx_bps': round(tx_bytes * 8 / seconds)}
+                else:
+                    rates[name] = {'rx_bps': None, 'tx_bps': None}
+
+        return rates
+
+    def history(self, window, resolution):
+        """ Returns {interface: [[time, rx_bps, tx_bps], ...]} covering the last window seconds,
+            averaged into buckets of resolution seconds. resolution is raised as needed to stay
+            within MAX_HISTORY_POINTS and is never finer than the sample interval. Returns the
+            resolution used as well.
+
+        """
+        resolution = max(resolution, self.interval, math.ceil(window / MAX_HISTORY_POINTS))
+        since = time.time() - window - self.interval
+
+        history = {}
+        with self._lock:
+            for name, ring in self._rings.items():
+                points = []
+                bucket = None
+                for t, seconds, rx_bytes, tx_bytes in _rates(ring.samples(since)):
+                    key = int(t // resolution)
+                    if key != bucket:
+                        bucket = key
+                        totals = [0, 0, 0]
+                        points.append((key, totals))
+                    totals[0] += seconds
+                    totals[1] += rx_bytes
+                    totals[2] += tx_bytes
+
+                history[name] = [[key * resolution, round(rx * 8 / seconds), round(tx * 8 / seconds)]
+                                 for key, (seconds, rx, tx) in points]
+
+        return history, resolution
@@ -1,32 +1,160 @@
 from flask import current_app
+import json
+import os
+import signal
 import subprocess
 import re
-import tohil
+from threading import Event, Lock
+import time
+
+from .netstats import get_network_stats
 
 cell_regex = re.compile(r"^Cell ([\d.]+)")
 ssid_regex = re.compile(r"^ESSID:\"(.*)\"$")
 frequency_regex = re.compile(r"^Frequency:([\d.]+)")
-encrypted_regex = re.compile(r"^Encryption key:(.*)$")
 signal_regex = re.compile(r"^Quality=(\d+)\/(\d+)\s+Signal level=(.+) d.+$")
 
+WIFI_NETWORKS_FILE = '/var/run/piaware-configurator/available_wifi_networks'
+WIFI_NETWORKS_JSON_FILE = '/var/run/piaware-configurator/available_wifi_networks.json'
+WIFI_SCAN_ACTIVITY_FILE = '/var/run/piaware-configurator/wifi_scan_activity'
+WIFI_SCAN_PIDFILE = '/var/run/piaware-configurator/piaware-wifi-scan.pid'
+
+# Seconds to wait for piaware-wifi-scan to publish requested results, and how often to check
+WIFI_SCAN_WAIT = 15
+WIFI_SCAN_POLL_INTERVAL = 0.25
+
+# Seconds before an in-process iwlist scan is abandoned
+WIFI_SCAN_TIMEOUT = 10
 
-def scan_wifi_networks(interface='wlan0'):
-    """ Scan for wifi networks using iwlist and return response
+
+class CoalescedCall:
+    """ Wraps a function so that callers arriving while a call is in progress wait for and share
+        its result (or exception) instead of starting another call
 
     """
+    def __init__(self, func):
+        self.func = func
+        self._lock = Lock()
+        self._pending = None
+        self.calls = 0
+        self.coalesced = 0
+
+    def __call__(self):
+        with self._lock:
+            pending = self._pending
+            leader = pending is None
+            if leader:
+                pending = self._pending = _PendingCall()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if leader:
+            try:
+                pending.result = self.func()
+            except Exception as e:
+                pending.error = e
+            finally:
+                with self._lock:
+                    self._pending = None
+                pending.done.set()
+        else:
+            pending.done.wait()
+
+        if pending.error is not None:
+            raise pending.error
+
+        return pending.result
+
+    def stats(self):
+        return {'calls': self.calls, 'coalesced': self.coalesced}
+
+
+class _PendingCall:
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+def _scan_wifi_networks(interface='wlan0'):
     cmd = ["sudo", "iwlist", interface, "scan"]
     proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    wifi_network_results = proc.stdout.read().decode('utf-8')
+    try:
+        wifi_network_results = proc.communicate(timeout=WIFI_SCAN_TIMEOUT)[0].decode('utf-8')
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        raise
+
     return wifi_network_results
 
 
+# Scan for wifi networks using iwlist and return response. Used when piaware-wifi-scan is not
+# running; concurrent requests share a single iwlist run.
+scan_wifi_networks = CoalescedCall(_scan_wifi_networks)
+
+
+def mark_wifi_scan_activity():
+    """ Tell piaware-wifi-scan that a configuration client is active, so it scans frequently
+
+    """
+    try:
+        os.utime(WIFI_SCAN_ACTIVITY_FILE)
+    except FileNotFoundError:
+        try:
+            open(WIFI_SCAN_ACTIVITY_FILE, 'a').close()
+        except OSError as e:
+            current_app.logger.debug(f'Could not create {WIFI_SCAN_ACTIVITY_FILE}: {e}')
+    except OSError as e:
+        current_app.logger.debug(f'Could not update {WIFI_SCAN_ACTIVITY_FILE}: {e}')
+
+
+def request_wifi_scan():
+    """ Ask piaware-wifi-scan for an immediate scan. Returns False if it is not running.
+
+    """
+    try:
+        with open(WIFI_SCAN_PIDFILE) as f:
+            pid = int(f.read())
+
+        # Make sure a stale pidfile does not point at some other process
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+            if b'piaware-wifi-scan' not in f.read():
+                return False
+
+        os.kill(pid, signal.SIGUSR1)
+    except (OSError, ValueError):
+        return False
+
+    return True
+
+
+def wait_for_wifi_scan(generation, timeout=WIFI_SCAN_WAIT):
+    """ Wait for piaware-wifi-scan to publish results newer than generation. Returns the new
+        results, or None on timeout. Sleeps between checks so other requests keep being served.
+
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        time.sleep(WIFI_SCAN_POLL_INTERVAL)
+        try:
+            scan_results = wifi_scan_results.get()
+        except (OSError, ValueError, KeyError, TypeError):
+            continue
+        if scan_results is not None and scan_results[1] > generation:
+            return scan_results
+
+    return None
+
+
 def get_wifi_networks(interface='wlan0'):
     """ Get available wifi networks created by wifi_scan helper script
 
     """
     wifi_network_results = ""
     try:
-        with open ('/var/run/piaware-configurator/available_wifi_networks') as f:
+        with open(WIFI_NETWORKS_FILE) as f:
             wifi_network_results = f.read()
     except Exception as e:
         current_app.logger.error(f'Error getting available wifi networks: {e}')
@@ -39,51 +167,136 @@ def parse_wifi_networks(data):
         using regex.
 
     """
+    return select_wifi_networks(parse_wifi_cells(data))
+
+
+def parse_wifi_cells(data):
+    """ Parse iwlist output into one dict per cell. piaware-wifi-scan publishes its iwlist output
+        to be parsed here, and cells of the same structure for nl80211 scans.
+
+        Each line is dispatched on its prefix so at most one regex runs per line.
+    """
     network_array = []
-    lines = data.split('\n')
-    for line in lines:
+    network = None
+    for line in data.split('\n'):
         line = line.strip()
-        cell_match = cell_regex.search(line)
-        if cell_match:
-            network_array.append({'wifi_cell': cell_match.group(1)})
+        if line.startswith('Cell '):
+            cell_match = cell_regex.match(line)
+            if cell_match:
+                network = {'wifi_cell': cell_match.group(1)}
+                network_array.append(network)
             continue
 
-        ssid_match = ssid_regex.search(line)
-        if ssid_match:
-            wireless_ssid = ssid_match.group(1)
-            network_array[-1].update({'wireless-ssid': wireless_ssid})
+        if network is None:
             continue
 
-        frequency_match = frequency_regex.search(line)
-        if frequency_match:
-            frequency = frequency_match.group(1)
-            is_5Ghz = True if frequency[0] == '5' else False
-            network_array[-1].update({'is_5Ghz': is_5Ghz})
-            continue
+        if line.startswith('ESSID:'):
+            ssid_match = ssid_regex.match(line)
+            if ssid_match:
+                network['wireless-ssid'] = ssid_match.group(1)
+        elif line.startswith('Frequency:'):
+            frequency_match = frequency_regex.match(line)
+            if frequency_match:
+                network['is_5Ghz'] = frequency_match.group(1)[0] == '5'
+        elif line.startswith('Encryption key:'):
+            network['encrypted'] = line[15:] == 'on'
+        elif line.startswith('Quality='):
+            signal_match = signal_regex.match(line)
+            if signal_match:
+                network['signal'] = signal_match.group(3)
 
-        encrypted_match = encrypted_regex.search(line)
-        if encrypted_match:
-            encrypted = True if encrypted_match.group(1) == 'on' else False
-            network_array[-1].update({'encrypted': encrypted})
-            continue
+    return network_array
 
-        signal_match = signal_regex.search(line)
-        if signal_match:
-            signal_level = signal_match.group(3)
-            network_array[-1].update({'signal': signal_level})
-            continue
 
-    # Return only non-duplicate wifi ssids that are valid and not hidden/empty
-    wifi_networks, wifi_network_set = [], []
+def signal_dbm(network):
+    """ Returns the signal level of a cell in dBm as a float, or -inf if it is unknown
+
+    """
+    try:
+        return float(network['signal'])
+    except (KeyError, TypeError, ValueError):
+        return float('-inf')
+
+
+def select_wifi_networks(network_array):
+    """ Returns the cells from parse_wifi_cells that should be offered to the user: one entry per
+        visible SSID, taken from the cell with the strongest signal, strongest first.
+
+        Each entry also lists the bands ("2.4" and/or "5" GHz) the SSID was seen on.
+    """
+    best = {}
+    bands = {}
     for network in network_array:
-        if network.get('wireless-ssid') and network['wireless-ssid'] and network['wireless-ssid'][0:4] != "\\x00" and network['wireless-ssid'] not in wifi_network_set:
-            wifi_networks.append(network)
-            wifi_network_set.append(network['wireless-ssid'])
+        ssid = network.get('wireless-ssid')
+        # Skip hidden/empty SSIDs
+        if not ssid or ssid[0:4] == "\\x00":
+            continue
 
-    return sorted(wifi_networks, key=lambda k: k['signal'])
+        bands.setdefault(ssid, set()).add('5' if network.get('is_5Ghz') else '2.4')
+        current = best.get(ssid)
+        if current is None or signal_dbm(network) > signal_dbm(current):
+            best[ssid] = network
+
+    wifi_networks = [dict(network, bands=sorted(bands[ssid], key=float)) for ssid, network in best.items()]
+
+    return sorted(wifi_networks, key=signal_dbm, reverse=True)
+
+class WifiScanResults:
+    """ Cache of the scan results published by piaware-wifi-scan, keyed on the file's inode, mtime
+        and size so the file is only read, parsed and filtered when the scanner replaces it.
+
+        get() returns (networks, generation, scan time), or None if no structured results exist.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._key = None
+        self._results = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            if key == self._key:
+                self.hits += 1
+                return self._results
+
+            with open(self.path) as f:
+                scan = json.load(f)
+
+            if 'networks' in scan:
+                cells = scan['networks']
+            else:
+                cells = parse_wifi_cells(scan['iwlist_output'])
+            self._results = (select_wifi_networks(cells), scan['generation'], scan['time'])
+            self._key = key
+            self.misses += 1
+
+            return self._results
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+wifi_scan_results = WifiScanResults(WIFI_NETWORKS_JSON_FILE)
+
+
+def get_transfer_rate_statistics(interfaces=None):
+    """ Returns the total bytes sent and received by all physical network interfaces.
+        interfaces is a result of netstats.get_network_stats(), read if not given.
+
+    """
+    if interfaces is None:
+        interfaces = get_network_stats()
 
-def get_transfer_rate_statistics():
-    total_tx_bytes = tohil.eval('expr {[::fa_sysinfo::interface_tx_bytes eth0] + [::fa_sysinfo::interface_tx_bytes wlan0]}', to=int)
-    total_rx_bytes = tohil.eval('expr {[::fa_sysinfo::interface_rx_bytes eth0] + [::fa_sysinfo::interface_rx_bytes wlan0]}', to=int)
+    physical = [stats for stats in interfaces.values() if stats['physical']]
+    total_tx_bytes = sum(stats['tx_bytes'] for stats in physical)
+    total_rx_bytes = sum(stats['rx_bytes'] for stats in physical)
 
-    return total_tx_bytes, total_rx_bytes
\ No newline at end of file
+    return total_tx_bytes, total_rx_bytes
@@ -1,6 +1,7 @@
-from app.main import app, setup_production_logger, socketio
+from app.main import app, setup_production_logger, socketio, start_background_tasks
 
 setup_production_logger()
+start_background_tasks()
 
 if __name__ == "__main__":
     socketio.run(app, host='0.0.0.0', debug=True)
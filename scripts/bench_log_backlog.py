@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+
+# Benchmark of reading the initial log backlog sent to a Socket.IO client: log_stream.tail_lines,
+# which scans backwards in blocks for exactly N lines, against the original approach of jumping
+# back a fixed 200*160 bytes, reading forward a byte at a time to the next new line and then
+# reading lines to the end of the file.
+#
+# With no --log, a piaware.log of --size-mb megabytes is generated in a temporary directory with
+# lines like piaware's, mostly short with occasional long ones.
+#
+#   python3 scripts/bench_log_backlog.py [--size-mb 8] [--log /var/log/piaware.log] [--number 200]
+import argparse
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'piaware-configurator'))
+
+from app.log_stream import tail_lines  # noqa: E402
+
+MESSAGES = [
+    '{time} [piaware] 1090 MHz: {n} msgs recv\'d from dump1090-fa ({m} in last 5m); {k} msgs sent to FlightAware\n',
+    '{time} [piaware] mlat-client(1234): Receiver status: connected\n',
+    '{time} [piaware] mlat-client(1234): Server status:   synchronized with {n} nearby receivers\n',
+    '{time} [piaware] mlat-client(1234): Aircraft: {n} of {m} Mode S, {k} of {m} ADS-B used\n',
+    '{time} [piaware] logged in to FlightAware as user guest\n',
+    '{time} [piaware] {n} msgs recv\'d from dump978-fa\n',
+    '{time} [piaware] server is sending alive messages; we will expect them\n',
+]
+
+LONG_MESSAGE = '{time} [piaware] mlat-client(1234): Results: {rates}\n'
+
+
+def generate_log(path, size_mb, seed=1090):
+    rng = random.Random(seed)
+    target = size_mb * 1024 * 1024
+    written = 0
+    with open(path, 'w') as f:
+        while written < target:
+            time = f'Oct {rng.randint(1, 28):2d} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}'
+            if rng.random() < 0.02:
+                line = LONG_MESSAGE.format(time=time, rates=' '.join(f'{rng.random():.3f}' for _ in range(150)))
+            else:
+                line = rng.choice(MESSAGES).format(time=time, n=rng.randint(0, 99999), m=rng.randint(0, 999),
+                                                   k=rng.randint(0, 9999))
+            f.write(line)
+            written += len(line)
+
+
+def previous_backlog(path):
+    with open(path, 'rb') as f:
+        f.seek(0, 2)
+        end_pos = f.tell()
+        curr_pos = max(0, end_pos - 200*160)
+
+        f.seek(curr_pos)
+        while True:
+            char = f.read(1)
+            curr_pos += 1
+            if not char or char == b'\n':
+                break
+
+        f.seek(curr_pos)
+        return [line.decode('utf-8', errors="replace") for line in f]
+
+
+def current_backlog(path, count):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        end_pos = os.fstat(fd).st_size
+        return [line.decode('utf-8', errors="replace") for line in tail_lines(fd, end_pos, count)]
+    finally:
+        os.close(fd)
+
+
+def best_us(func, number, repeat):
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark reading the initial log backlog')
+    parser.add_argument('--log', help='log file to read instead of a generated one')
+    parser.add_argument('--size-mb', type=int, default=8, help='size of the generated log')
+    parser.add_argument('--number', type=int, default=200, help='reads per timing run')
+    parser.add_argument('--repeat', type=int, default=10, help='timing runs; the best one is reported')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = args.log
+        if path is None:
+            path = os.path.join(tmp_dir, 'piaware.log')
+            generate_log(path, args.size_mb)
+
+        print(f'{path}: {os.path.getsize(path) / 1024 / 1024:.1f} MB')
+        print(f'{"backlog":>28}  {"lines":>5}  {"time":>10}')
+
+        lines = len(previous_backlog(path))
+        elapsed = best_us(lambda: previous_backlog(path), args.number, args.repeat)
+        print(f'{"last 32000 bytes, byte scan":>28}  {lines:5d}  {elapsed:7.0f} us')
+
+        for count in (lines, 200, 2000):
+            lines = len(current_backlog(path, count))
+            elapsed = best_us(lambda: current_backlog(path, count), args.number, args.repeat)
+            print(f'{f"tail_lines, {count} lines":>28}  {lines:5d}  {elapsed:7.0f} us')
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+
+# Benchmark of the network statistics behind /system/status and get_network_info: the netstats
+# module (sysfs and one netlink address dump) against the fa_sysinfo Tcl calls it replaced.
+#
+#   transfer counters  get_transfer_rate_statistics() vs the two interface_tx_bytes/rx_bytes evals
+#   network info       get_network_stats() vs the five fa_sysinfo lookups get_network_info made
+#
+# The Tcl side needs tohil and piaware's fa_sysinfo package, so run this on a PiAware image for
+# the comparison; elsewhere only the netstats side is timed. The Tcl calls are timed uncached.
+# Needs Flask.
+#
+#   python3 scripts/bench_netstats.py [--number 500] [--repeat 10]
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'piaware-configurator'))
+
+from app import netstats  # noqa: E402
+from app.wifi_helpers import get_transfer_rate_statistics  # noqa: E402
+
+
+def load_tcl():
+    """ Returns tohil with fa_sysinfo loaded, or None if either is missing
+
+    """
+    try:
+        import tohil
+        tohil.eval('package require fa_sysinfo')
+    except Exception as e:
+        print(f'Not timing the Tcl calls: {e}')
+        return None
+
+    return tohil
+
+
+def previous_transfer_counters(tohil):
+    total_tx_bytes = tohil.eval('expr {[::fa_sysinfo::interface_tx_bytes eth0] + [::fa_sysinfo::interface_tx_bytes wlan0]}', to=int)
+    total_rx_bytes = tohil.eval('expr {[::fa_sysinfo::interface_rx_bytes eth0] + [::fa_sysinfo::interface_rx_bytes wlan0]}', to=int)
+    return total_tx_bytes, total_rx_bytes
+
+
+def previous_network_info(tohil):
+    eth0_ipaddress = tohil.eval('::fa_sysinfo::interface_ip_address eth0', to=str)
+    wlan_interface = tohil.eval('::fa_sysinfo::wireless_interface', to=str)
+    wlan_ipaddress = tohil.eval(f'::fa_sysinfo::interface_ip_address {wlan_interface}', to=str)
+    ethernet_state = tohil.eval('::fa_sysinfo::interface_state eth0', to=str)
+    wifi_state = tohil.eval(f'::fa_sysinfo::interface_state {wlan_interface}', to=str)
+    return eth0_ipaddress, wlan_ipaddress, ethernet_state, wifi_state
+
+
+def current_transfer_counters():
+    return get_transfer_rate_statistics(netstats.get_network_stats())
+
+
+def current_network_info():
+    interfaces = netstats.get_network_stats()
+    wlan_interface = netstats.wireless_interface()
+    return (netstats.interface_ip_address(interfaces, 'eth0'),
+            netstats.interface_ip_address(interfaces, wlan_interface),
+            netstats.interface_state(interfaces, 'eth0'),
+            netstats.interface_state(interfaces, wlan_interface))
+
+
+def best_us(func, number, repeat):
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark reading network interface statistics')
+    parser.add_argument('--number', type=int, default=500, help='calls per timing run')
+    parser.add_argument('--repeat', type=int, default=10, help='timing runs; the best one is reported')
+    args = parser.parse_args()
+
+    tohil = load_tcl()
+    print(f'interfaces: {", ".join(netstats.interface_names()) or "none"}')
+    print(f'{"":>18}  {"fa_sysinfo":>10}  {"netstats":>10}')
+    for name, previous, current in (('transfer counters', previous_transfer_counters, current_transfer_counters),
+                                    ('network info', previous_network_info, current_network_info)):
+        after = best_us(current, args.number, args.repeat)
+        if tohil is None:
+            before = '-'
+        else:
+            before = f'{best_us(lambda: previous(tohil), args.number, args.repeat):7.0f} us'
+        print(f'{name:>18}  {before:>10}  {after:7.0f} us')
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
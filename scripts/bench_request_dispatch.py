@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+
+# Benchmark of the per-request dispatch and payload validation overhead of /configurator: the
+# REQUEST_HANDLERS registry with its PayloadSchemas against the previous if/elif chain, whose
+# handlers each checked the payload shape and validated setting names against whitelist lists.
+#
+# Handlers are replaced with no-ops on both sides so only the dispatch and validation are timed.
+# The previous chain, checks and whitelists are reproduced below.
+#
+#   python3 scripts/bench_request_dispatch.py [--number 20000] [--repeat 10]
+#
+# Needs the configurator's Python dependencies, including tohil.
+import argparse
+from http import HTTPStatus
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'piaware-configurator'))
+
+from app import main as configurator  # noqa: E402
+from app import message_handlers  # noqa: E402
+from app.common import PiAwareConfigAsciiStringException, PiAwareConfigPermissionException  # noqa: E402
+from app.dispatch import RequestHandler  # noqa: E402
+
+PREVIOUS_READ_WHITELIST = [
+    "allow-ble-setup",  "image-type", "flightfeeder-serial", "rtlsdr-gain", "uat-sdr-gain",
+    "wireless-network", "wireless-type", "wireless-address", "wireless-ssid", "wireless-netmask", "wireless-gateway", "wireless-country", "wireless-broadcast", "wireless-nameservers",
+    "wired-network", "wired-type", "wired-address", "wired-netmask", "wired-gateway", "wired-broadcast", "wired-nameservers"
+    ]
+PREVIOUS_WRITE_WHITELIST = ["allow-ble-setup", "wireless-network", "wireless-type", "wireless-address", "wireless-ssid", "wireless-netmask", "wireless-gateway", "wireless-country", "wireless-broadcast", "wireless-nameservers", "wireless-password",
+    "wired-network", "wired-type", "wired-address", "wired-netmask", "wired-gateway", "wired-broadcast", "wired-nameservers", "rtlsdr-gain"]
+
+CASES = {
+    'config_read, 3 settings': {"request": "piaware_config_read",
+                                "request_payload": ["wireless-ssid", "rtlsdr-gain", "image-type"]},
+    'config_write, 2 settings': {"request": "piaware_config_write",
+                                 "request_payload": {"wireless-ssid": "home", "rtlsdr-gain": "20"}},
+    'read not allowed': {"request": "piaware_config_read", "request_payload": ["wireless-password"]},
+    'missing payload': {"request": "piaware_config_write"},
+    'delete_pending (last)': {"request": "delete_pending_network_settings"},
+    'unsupported': {"request": "nope"},
+    'request not a string': {"request": ["nope"]},
+}
+
+
+def handled(*args):
+    return {"success": True}, HTTPStatus.OK
+
+
+def previous_validate(settings, whitelist):
+    for setting in settings:
+        if not setting.isascii():
+            raise PiAwareConfigAsciiStringException(setting)
+
+        if setting not in whitelist:
+            raise PiAwareConfigPermissionException(setting)
+
+
+def previous_read(config_request):
+    try:
+        read_settings = config_request['request_payload']
+        if type(read_settings) is not list:
+            raise TypeError
+        previous_validate(read_settings, PREVIOUS_READ_WHITELIST)
+        return handled()
+    except KeyError:
+        return {"success": False, "error": "Missing request_payload field"}, HTTPStatus.BAD_REQUEST
+    except TypeError:
+        return {"success": False, "error": "Request_payload must be a list of settings to read"}, HTTPStatus.BAD_REQUEST
+    except PiAwareConfigPermissionException as e:
+        return {"success": False, "error": f"Reading {e.setting} is not allowed"}, HTTPStatus.OK
+    except PiAwareConfigAsciiStringException:
+        return {"success": False, "error": "Badly formatted setting"}, HTTPStatus.OK
+
+
+def previous_write(config_request):
+    try:
+        write_settings = config_request['request_payload']
+        if type(write_settings) is not dict:
+            raise TypeError
+        previous_validate(write_settings, PREVIOUS_WRITE_WHITELIST)
+        return handled()
+    except KeyError:
+        return {"success": False, "error": "Missing request_payload field"}, HTTPStatus.BAD_REQUEST
+    except TypeError:
+        return {"success": False, "error": "request_payload must be a dict"}, HTTPStatus.BAD_REQUEST
+    except PiAwareConfigPermissionException as e:
+        return {"success": False, "error": f"Setting {e.setting} is not allowed"}, HTTPStatus.OK
+    except PiAwareConfigAsciiStringException:
+        return {"success": False, "error": "Badly formatted setting"}, HTTPStatus.OK
+
+
+def previous_dispatch(request, json_payload):
+    if request == 'piaware_config_read':
+        return previous_read(json_payload)
+    elif request == 'piaware_config_write':
+        return previous_write(json_payload)
+    elif request == 'get_device_info':
+        return handled()
+    elif request == 'get_device_state':
+        return handled(json_payload)
+    elif request == 'get_network_info':
+        return handled()
+    elif request == 'get_wifi_networks':
+        return handled(json_payload)
+    elif request == 'set_wifi_config':
+        return handled(json_payload)
+    elif request == 'restart_receiver':
+        return handled()
+    elif request == 'restart_network':
+        return handled()
+    elif request == 'reboot':
+        return handled()
+    elif request == 'get_pending_network_config':
+        return handled(json_payload)
+    elif request == 'set_pending_network_config':
+        return handled(json_payload)
+    elif request == 'save_pending_network_settings':
+        return handled()
+    elif request == 'delete_pending_network_settings':
+        return handled()
+    else:
+        return {"success": False, "error": "Unsupported request"}, HTTPStatus.BAD_REQUEST
+
+
+# The current registry, with the same schemas but no-op handlers
+REQUEST_HANDLERS = {name: RequestHandler(handled, handler.schema)
+                    for name, handler in message_handlers.REQUEST_HANDLERS.items()}
+
+
+def current_dispatch(request, json_payload):
+    handler = REQUEST_HANDLERS.get(request) if isinstance(request, str) else None
+    if handler is not None:
+        return handler.dispatch(json_payload)
+
+    return {"success": False, "error": "Unsupported request"}, HTTPStatus.BAD_REQUEST
+
+
+def compare_us(before, after, number, repeat):
+    """ Best per-call time in microseconds of before and after, timed alternately so both see the same load
+
+    """
+    times = ([], [])
+    for _ in range(repeat):
+        for func, results in zip((before, after), times):
+            results.append(timeit.timeit(func, number=number))
+    return tuple(min(results) / number * 1e6 for results in times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark /configurator request dispatch and validation')
+    parser.add_argument('--number', type=int, default=20000, help='calls per timing run')
+    parser.add_argument('--repeat', type=int, default=10, help='timing runs; the best one is reported')
+    args = parser.parse_args()
+
+    # The config exceptions log an error when raised
+    configurator.app.logger.setLevel(logging.CRITICAL)
+
+    print(f'{"request":>26}  {"if/elif chain":>13}  {"registry":>9}')
+    with configurator.app.app_context():
+        for name, payload in CASES.items():
+            request = payload['request']
+            if previous_dispatch(request, payload)[0].get('error') != current_dispatch(request, payload)[0].get('error'):
+                print(f'{name}: responses differ')
+                return 1
+
+            before, after = compare_us(lambda: previous_dispatch(request, payload),
+                                       lambda: current_dispatch(request, payload), args.number, args.repeat)
+            print(f'{name:>26}  {before:10.2f} us  {after:6.2f} us')
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+
+# Benchmark of the /configurator request ingest path: validate_json and the request logging in
+# dispatch_request, against the previous implementations, for a small request and a batch-sized one.
+#
+# The previous validate_json decoded request.data to test for UTF-8 and then called
+# request.get_json() twice; the previous logging built its f-strings even with debug logging off.
+# Both are reproduced below. validate_json is timed together with building the test request context
+# it reads from. Logging runs at INFO level, as in production.
+#
+# Expect the validate_json timings to be about the same, within run-to-run noise. Flask caches the
+# parsed body, so the previous get_json() calls already parsed it only once. The single-parse
+# validate_json is a cleanup that adds the MAX_REQUEST_BYTES check, not a speedup. The saving is in
+# the logging, which no longer formats whole payloads when debug logging is off.
+#
+#   python3 scripts/bench_request_ingest.py [--number 2000] [--repeat 10]
+#
+# Needs the configurator's Python dependencies, including tohil.
+import argparse
+import json
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'piaware-configurator'))
+
+from flask import abort, jsonify, make_response  # noqa: E402
+from http import HTTPStatus  # noqa: E402
+
+from app import main as configurator  # noqa: E402
+
+SMALL = {"request": "piaware_config_read", "request_payload": ["wireless-ssid", "rtlsdr-gain"]}
+
+BATCH = {"request": "batch",
+         "requests": [{"request": "set_pending_network_config",
+                       "request_payload": {f"wireless-{key}": "x" * 200
+                                           for key in ("ssid", "password", "address", "netmask",
+                                                       "gateway", "broadcast", "nameservers", "country")}}]
+         * configurator.MAX_BATCH_REQUESTS}
+
+
+def previous_validate_json(request):
+    if not request.is_json:
+        abort(make_response(jsonify(success=False, error="content-type must be application/json"),
+                            HTTPStatus.UNSUPPORTED_MEDIA_TYPE))
+
+    try:
+        _ = request.data.decode("utf-8")
+    except UnicodeDecodeError:
+        abort(make_response(jsonify(sucess=False, error="Data must be UTF-8 encoded"), HTTPStatus.BAD_REQUEST))
+
+    if not isinstance(request.get_json(silent=True), dict):
+        abort(make_response(jsonify(sucess=False, error="Invalid json in request"), HTTPStatus.BAD_REQUEST))
+
+    return request.get_json()
+
+
+def previous_logging(request, json_payload):
+    configurator.app.logger.info(f'Incoming request: {request}')
+    configurator.app.logger.debug(f'{json_payload}')
+    configurator.app.logger.debug(f'Response: {json_payload}')
+
+
+def current_logging(request, json_payload):
+    configurator.app.logger.info('Incoming request: %s', request)
+    configurator.app.logger.debug('%s', json_payload)
+    configurator.app.logger.debug('Response: %s', json_payload)
+
+
+def compare_us(before, after, number, repeat):
+    """ Best per-call time in microseconds of before and after, timed alternately so both see the same load
+
+    """
+    times = ([], [])
+    for _ in range(repeat):
+        for func, results in zip((before, after), times):
+            results.append(timeit.timeit(func, number=number))
+    return tuple(min(results) / number * 1e6 for results in times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark /configurator request ingest')
+    parser.add_argument('--number', type=int, default=2000, help='calls per timing run')
+    parser.add_argument('--repeat', type=int, default=10, help='timing runs; the best one is reported')
+    args = parser.parse_args()
+
+    configurator.app.logger.setLevel(logging.INFO)
+    configurator.app.logger.handlers = [logging.NullHandler()]
+    configurator.app.logger.propagate = False
+
+    print(f'{"payload":>16}  {"validate_json before":>20}  {"after":>9}  {"logging before":>14}  {"after":>9}')
+    for name, payload in (('small', SMALL), ('batch', BATCH)):
+        body = json.dumps(payload).encode()
+
+        def ingest(validate):
+            with configurator.app.test_request_context('/configurator', method='POST', data=body,
+                                                       content_type='application/json'):
+                assert validate(configurator.request) == payload
+
+        with configurator.app.app_context():
+            before, after = compare_us(lambda: ingest(previous_validate_json),
+                                       lambda: ingest(configurator.validate_json), args.number, args.repeat)
+            log_before, log_after = compare_us(lambda: previous_logging(payload['request'], payload),
+                                               lambda: current_logging(payload['request'], payload),
+                                               args.number, args.repeat)
+
+        label = f'{name} ({len(body)} B)'
+        print(f'{label:>16}  {before:17.1f} us  {after:6.1f} us  {log_before:11.1f} us  {log_after:6.1f} us')
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+
+# Benchmark of parse_wifi_networks on iwlist scan output against the previous parser, which tried
+# every regex on every line, deduplicated SSIDs with a list and sorted on the signal string.
+#
+# With no arguments, iwlist output with 20, 100 and 500 cells is generated: a mix of SSIDs seen on
+# several access points and bands, hidden networks and open ones, with the lines iwlist prints for
+# each cell. Captured output (sudo iwlist wlan0 scan > scan.txt) can be given instead.
+#
+#   python3 scripts/bench_wifi_parse.py [--number 50] [--repeat 10] [scan.txt ...]
+#
+# Needs Flask.
+import argparse
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'piaware-configurator'))
+
+from app.wifi_helpers import parse_wifi_networks  # noqa: E402
+
+cell_regex = re.compile(r"^Cell ([\d.]+)")
+ssid_regex = re.compile(r"^ESSID:\"(.*)\"$")
+frequency_regex = re.compile(r"^Frequency:([\d.]+)")
+encrypted_regex = re.compile(r"^Encryption key:(.*)$")
+signal_regex = re.compile(r"^Quality=(\d+)\/(\d+)\s+Signal level=(.+) d.+$")
+
+CELL = '''          Cell {cell:02d} - Address: 02:00:00:00:{hi:02X}:{lo:02X}
+                    Channel:{channel}
+                    Frequency:{frequency} GHz (Channel {channel})
+                    Quality={quality}/70  Signal level={signal} dBm
+                    Encryption key:{encryption}
+                    ESSID:"{ssid}"
+                    Bit Rates:1 Mb/s; 2 Mb/s; 5.5 Mb/s; 11 Mb/s; 6 Mb/s
+                              9 Mb/s; 12 Mb/s; 18 Mb/s
+                    Bit Rates:24 Mb/s; 36 Mb/s; 48 Mb/s; 54 Mb/s
+                    Mode:Master
+                    Extra:tsf=0000001d2a9f0c41
+                    Extra: Last beacon: 40ms ago
+                    IE: Unknown: 00{ssid_hex}
+                    IE: IEEE 802.11i/WPA2 Version 1
+                        Group Cipher : CCMP
+                        Pairwise Ciphers (1) : CCMP
+                        Authentication Suites (1) : PSK
+'''
+
+
+def generate_scan(cells, seed=1090):
+    rng = random.Random(seed)
+    ssids = [f'Network-{i}' for i in range(max(1, cells // 3))]
+    output = ['wlan0     Scan completed :']
+    for cell in range(1, cells + 1):
+        if rng.random() < 0.05:
+            ssid = '\\x00' * 8
+        else:
+            ssid = rng.choice(ssids)
+        if rng.random() < 0.4:
+            channel = rng.choice([36, 40, 44, 48, 149, 153, 157, 161])
+            frequency = f'{5 + channel * 5 / 1000:.3f}'
+        else:
+            channel = rng.randint(1, 11)
+            frequency = f'{2.407 + channel * 5 / 1000:.3f}'
+        signal = rng.randint(-92, -30)
+        output.append(CELL.format(cell=cell, hi=cell >> 8, lo=cell & 0xff, channel=channel, frequency=frequency,
+                                  quality=min(70, signal + 110), signal=signal,
+                                  encryption='off' if rng.random() < 0.1 else 'on',
+                                  ssid=ssid, ssid_hex=ssid.encode().hex()))
+    return '\n'.join(output)
+
+
+def previous_parse_wifi_networks(data):
+    network_array = []
+    lines = data.split('\n')
+    for line in lines:
+        line = line.strip()
+        cell_match = cell_regex.search(line)
+        if cell_match:
+            network_array.append({'wifi_cell': cell_match.group(1)})
+            continue
+
+        ssid_match = ssid_regex.search(line)
+        if ssid_match:
+            network_array[-1].update({'wireless-ssid': ssid_match.group(1)})
+            continue
+
+        frequency_match = frequency_regex.search(line)
+        if frequency_match:
+            network_array[-1].update({'is_5Ghz': True if frequency_match.group(1)[0] == '5' else False})
+            continue
+
+        encrypted_match = encrypted_regex.search(line)
+        if encrypted_match:
+            network_array[-1].update({'encrypted': True if encrypted_match.group(1) == 'on' else False})
+            continue
+
+        signal_match = signal_regex.search(line)
+        if signal_match:
+            network_array[-1].update({'signal': signal_match.group(3)})
+            continue
+
+    wifi_networks, wifi_network_set = [], []
+    for network in network_array:
+        if network.get('wireless-ssid') and network['wireless-ssid'] and network['wireless-ssid'][0:4] != "\\x00" and network['wireless-ssid'] not in wifi_network_set:
+            wifi_networks.append(network)
+            wifi_network_set.append(network['wireless-ssid'])
+
+    return sorted(wifi_networks, key=lambda k: k['signal'])
+
+
+def compare_us(before, after, number, repeat):
+    """ Best per-call time in microseconds of before and after, timed alternately so both see the same load
+
+    """
+    times = ([], [])
+    for _ in range(repeat):
+        for func, results in zip((before, after), times):
+            results.append(timeit.timeit(func, number=number))
+    return tuple(min(results) / number * 1e6 for results in times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark parsing iwlist scan output')
+    parser.add_argument('--number', type=int, default=50, help='parses per timing run')
+    parser.add_argument('--repeat', type=int, default=10, help='timing runs; the best one is reported')
+    parser.add_argument('scans', nargs='*', help='files of captured iwlist scan output')
+    args = parser.parse_args()
+
+    if args.scans:
+        scans = []
+        for path in args.scans:
+            with open(path) as f:
+                scans.append((os.path.basename(path), f.read()))
+    else:
+        scans = [(f'{cells} cells', generate_scan(cells)) for cells in (20, 100, 500)]
+
+    print(f'{"scan":>16}  {"cells":>5}  {"ssids":>5}  {"before":>10}  {"after":>10}')
+    for name, data in scans:
+        cells = data.count('Cell ')
+        networks = parse_wifi_networks(data)
+        before, after = compare_us(lambda: previous_parse_wifi_networks(data), lambda: parse_wifi_networks(data),
+                                   args.number, args.repeat)
+        print(f'{name:>16}  {cells:5d}  {len(networks):5d}  {before:7.0f} us  {after:7.0f} us')
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
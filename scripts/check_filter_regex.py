@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+
+# Check that compile_filter_regex refuses log filter regexes that can backtrack catastrophically,
+# accepts ordinary ones, and that no accepted pattern takes long on lines built to make it
+# backtrack. Run from anywhere: python3 scripts/check_filter_regex.py
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'piaware-configurator'))
+
+from app.log_history import compile_filter_regex, MAX_FILTER_REGEX_LENGTH  # noqa: E402
+
+REJECTED = [
+    '.*.*.*.*.*.*.*.*.*.*.*.*x',
+    '(a|aa)+$',
+    '(a+)+',
+    '(a*)*b',
+    '(a?)+',
+    '(?:ab|a)*c',
+    '(\\w+)\\s\\1',
+    '(?P<x>a)(?(x)b|c)',
+    'a.*b.*c',
+    '\\d+ msgs.*sent',
+    'x{0,1000}y{0,1000}',
+    'a' * (MAX_FILTER_REGEX_LENGTH + 1),
+    '(unclosed',
+]
+
+ACCEPTED = [
+    'mlat',
+    'fail|error',
+    '^.*(fail|error)',
+    'mlat.*synchronized',
+    '\\d+ msgs recv',
+    '\\d{1,3}\\.\\d{1,3}\\.\\d{1,3}\\.\\d{1,3}',
+    '[ab]+c',
+    '(?:ab)*x',
+    '(?i)logged in to flightaware',
+]
+
+# Lines a little over the filter's line limit that make the patterns above backtrack as much
+# as they can
+HOSTILE_LINES = ['a' * 300, 'ab' * 150, 'x' * 300, '1.' * 150, ' ' * 300]
+
+# Slowest acceptable match of one pattern against one line
+MAX_SECONDS_PER_LINE = 0.005
+
+
+def main():
+    failures = 0
+    for pattern in REJECTED:
+        try:
+            compile_filter_regex(pattern)
+        except ValueError as e:
+            print(f'refused  {pattern[:40]!r}: {e}')
+        else:
+            print(f'FAILED: {pattern[:40]!r} was accepted')
+            failures += 1
+
+    for pattern in ACCEPTED:
+        try:
+            regex = compile_filter_regex(pattern)
+        except ValueError as e:
+            print(f'FAILED: {pattern!r} was refused: {e}')
+            failures += 1
+            continue
+
+        slowest = 0.0
+        for line in HOSTILE_LINES:
+            start = time.perf_counter()
+            regex.search(line)
+            slowest = max(slowest, time.perf_counter() - start)
+
+        if slowest > MAX_SECONDS_PER_LINE:
+            print(f'FAILED: {pattern!r} took {slowest * 1000:.1f} ms on one line')
+            failures += 1
+        else:
+            print(f'accepted {pattern!r}: at most {slowest * 1000:.2f} ms per line')
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
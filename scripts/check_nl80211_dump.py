@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+
+# Check piaware-wifi-scan's nl80211 parser against recorded NL80211_CMD_GET_SCAN dumps.
+#
+# Each testdata/*.hex dump holds one netlink message per line as hex ('#' lines are comments) and
+# has a matching entry in EXPECTED. Run from anywhere: python3 scripts/check_nl80211_dump.py
+import importlib.machinery
+import importlib.util
+import os
+import sys
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+EXPECTED = {
+    'nl80211-scan-dump.hex': [
+        {'wifi_cell': '01', 'bssid': '02:11:22:33:44:01', 'frequency': 2437, 'channel': 6, 'is_5Ghz': False,
+         'encrypted': True, 'signal_dbm': -45.0, 'signal': '-45', 'wireless-ssid': 'HomeNet'},
+        {'wifi_cell': '02', 'bssid': '02:11:22:33:44:02', 'frequency': 5180, 'channel': 36, 'is_5Ghz': True,
+         'encrypted': True, 'signal_dbm': -61.0, 'signal': '-61', 'wireless-ssid': 'HomeNet'},
+        # Hidden network: the SSID element is all zero bytes, escaped the way iwlist prints it
+        {'wifi_cell': '03', 'bssid': '02:11:22:33:44:03', 'frequency': 2412, 'channel': 1, 'is_5Ghz': False,
+         'encrypted': True, 'signal_dbm': -82.0, 'signal': '-82', 'wireless-ssid': '\\x00' * 7},
+        {'wifi_cell': '04', 'bssid': '02:11:22:33:44:04', 'frequency': 2462, 'channel': 11, 'is_5Ghz': False,
+         'encrypted': False, 'signal_dbm': -78.0, 'signal': '-78', 'wireless-ssid': 'Café Wi-Fi'},
+        # 6 GHz channel 5; below 6000 MHz, so reported as 5 GHz just like iwlist's Frequency:5.975 GHz
+        {'wifi_cell': '05', 'bssid': '02:11:22:33:44:05', 'frequency': 5975, 'channel': 5, 'is_5Ghz': True,
+         'encrypted': True, 'signal_dbm': -55.0, 'signal': '-55', 'wireless-ssid': 'Office6E'},
+    ],
+}
+
+
+def load_scanner():
+    path = os.path.join(SCRIPTS_DIR, 'piaware-wifi-scan')
+    loader = importlib.machinery.SourceFileLoader('piaware_wifi_scan', path)
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def read_dump(path):
+    with open(path) as f:
+        return b''.join(bytes.fromhex(line.strip()) for line in f if line.strip() and not line.startswith('#'))
+
+
+def main():
+    scanner = load_scanner()
+    failures = 0
+    for name, expected in EXPECTED.items():
+        networks = scanner.parse_scan_results(read_dump(os.path.join(SCRIPTS_DIR, 'testdata', name)))
+        if networks == expected:
+            print(f'{name}: ok, {len(networks)} cells')
+            continue
+
+        failures += 1
+        print(f'{name}: FAILED')
+        for i in range(max(len(networks), len(expected))):
+            got = networks[i] if i < len(networks) else None
+            want = expected[i] if i < len(expected) else None
+            if got != want:
+                print(f'  cell {i + 1}: expected {want}\n  cell {i + 1}: got      {got}')
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+
+# Stress test: the piaware log keeps streaming smoothly while a slow piaware-config write is in flight.
+#
+# Runs piaware-configurator in-process under eventlet with a stub Tcl interpreter (a tohil module
+# written to a temporary directory) whose write_config blocks its OS thread for --write-seconds, as
+# a slow fa_piaware_config write does. A greenlet appends a line to a temporary piaware.log every
+# --line-interval seconds while a Socket.IO test client is subscribed to the log, and the
+# configurator is sent --writes piaware_config_write requests. Reports the delivery latency of the
+# log lines and the largest stall of the event loop, and exits non-zero if a line took longer than
+# half a config write to arrive.
+#
+# --direct runs the Tcl calls on the calling greenlet instead of the Tcl thread, as before the
+# TclExecutor, to show what the test catches.
+#
+#   python3 scripts/stress_tcl_log_stream.py [--writes 3] [--write-seconds 1.0] [--direct]
+#
+# Needs the configurator's Python dependencies (Flask, Flask-SocketIO, eventlet).
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+CONFIGURATOR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'piaware-configurator')
+
+STUB_TOHIL = '''
+# Stub of the embedded Tcl interpreter used by scripts/stress_tcl_log_stream.py
+try:
+    from eventlet.patcher import original
+    _sleep = original('time').sleep
+except ImportError:
+    from time import sleep as _sleep
+
+WRITE_CONFIG_SECONDS = {write_seconds}
+
+_options = {{'image-type': 'piaware', 'wireless-ssid': 'home', 'rtlsdr-gain': '20'}}
+
+
+def eval(script, to=None):
+    if script.endswith(' write_config'):
+        # Like Tcl, block the whole OS thread, not just the calling greenlet
+        _sleep(WRITE_CONFIG_SECONDS)
+    if 'route_to_flightaware' in script:
+        return 1
+    return ''
+
+
+def call(obj, op, *args):
+    if op == 'get':
+        return _options.get(args[0], '')
+    if op == 'set_option':
+        _options[args[0]] = str(args[1])
+    return ''
+
+
+def getvar(name, to=None):
+    return '192.0.2.10' if name == 'ip' else 'wlan0'
+'''
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stream the piaware log while slow config writes run')
+    parser.add_argument('--writes', type=int, default=3, help='config writes to send')
+    parser.add_argument('--write-seconds', type=float, default=1.0, help='seconds each stub write_config blocks')
+    parser.add_argument('--line-interval', type=float, default=0.02, help='seconds between log lines')
+    parser.add_argument('--direct', action='store_true', help='call Tcl on the calling greenlet (no TclExecutor)')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='stress-tcl-')
+    with open(os.path.join(tmp_dir, 'tohil.py'), 'w') as f:
+        f.write(STUB_TOHIL.format(write_seconds=args.write_seconds))
+    log_path = os.path.join(tmp_dir, 'piaware.log')
+    open(log_path, 'w').close()
+
+    import eventlet
+    eventlet.monkey_patch()
+
+    sys.path[:0] = [tmp_dir, CONFIGURATOR_DIR]
+    from app import log_stream
+    log_stream.PIAWARE_LOG_FILE = log_path
+    from app import main as configurator
+
+    if args.direct:
+        import tohil
+        configurator.tcl_executor.run = lambda func: func(tohil)
+
+    http = configurator.app.test_client()
+    sio = configurator.socketio.test_client(configurator.app, flask_test_client=http)
+    sio.get_received()
+
+    written = {}
+    latencies = []
+    stalls = [0.0]
+    running = [True]
+
+    def write_lines():
+        seq = 0
+        while running[0]:
+            with open(log_path, 'a') as f:
+                f.write(f'stress line {seq}\n')
+            written[seq] = time.monotonic()
+            seq += 1
+            eventlet.sleep(args.line_interval)
+
+    def read_lines():
+        while running[0]:
+            now = time.monotonic()
+            for event in sio.get_received():
+                if event['name'] == 'log_data' and event['args'][0].startswith('stress line '):
+                    latencies.append(now - written[int(event['args'][0].split()[2])])
+            eventlet.sleep(0.005)
+
+    def tick():
+        while running[0]:
+            start = time.monotonic()
+            eventlet.sleep(0.01)
+            stalls[0] = max(stalls[0], time.monotonic() - start - 0.01)
+
+    workers = [eventlet.spawn(write_lines), eventlet.spawn(read_lines), eventlet.spawn(tick)]
+    eventlet.sleep(0.5)
+
+    write_times = []
+    for i in range(args.writes):
+        start = time.monotonic()
+        response = http.post('/configurator', json={'request': 'piaware_config_write',
+                                                    'request_payload': {'rtlsdr-gain': 21 + i}})
+        write_times.append(time.monotonic() - start)
+        if response.status_code != 200 or response.get_json().get('success') is not True:
+            print(f'Config write failed: {response.status_code} {response.get_data(as_text=True)}')
+            return 2
+        eventlet.sleep(0.3)
+
+    running[0] = False
+    for worker in workers:
+        worker.wait()
+
+    mode = 'direct Tcl calls' if args.direct else 'TclExecutor'
+    print(f'{mode}: {args.writes} config writes of {args.write_seconds:.1f} s '
+          f'(took {", ".join(f"{t:.2f}" for t in write_times)} s)')
+    if not latencies:
+        print('No log lines were delivered')
+        return 1
+
+    print(f'log lines delivered: {len(latencies)} of {len(written)}')
+    print(f'delivery latency: p50 {percentile(latencies, 0.5) * 1000:.0f} ms, '
+          f'p99 {percentile(latencies, 0.99) * 1000:.0f} ms, max {max(latencies) * 1000:.0f} ms')
+    print(f'largest event loop stall: {stalls[0] * 1000:.0f} ms')
+
+    if max(latencies) > args.write_seconds / 2:
+        print('FAIL: log streaming stalled during a config write')
+        return 1
+
+    print('OK: log streaming stayed smooth during config writes')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())